@@ -2,15 +2,16 @@ import os
 import uuid
 import time
 import sqlalchemy as sa
-from fastapi import FastAPI, Header, HTTPException, Depends, Response, Cookie, Body
+from fastapi import FastAPI, Header, HTTPException, Depends, Response, Cookie, Body, Request
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta
 from pydantic import BaseModel
 from sqlalchemy import cast, case, Integer
 import httpx
 from sqlalchemy.orm import sessionmaker, declarative_base
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.context import CryptContext
 from jose import JWTError, jwt
@@ -21,13 +22,86 @@ import psutil
 from sqlalchemy.engine import Engine
 from pathlib import Path
 import json
+import hashlib
+import random
+import secrets
+import socket
+from urllib.parse import quote, urlsplit, urlunsplit
+import threading
+import asyncio
+import heapq
+import itertools
+from collections import OrderedDict, deque
+from typing import NamedTuple
 
 load_dotenv()
 #configurations
 DB_URL = os.getenv("DB_URL", "sqlite:///./fortress-stack.db")
 SECRET_KEY = os.getenv("SECRET_KEY", "secret12345")
 ALGORITHM = "HS256"
+OPERATOR_TOKEN = os.getenv("OPERATOR_TOKEN", "")  # X-Operator-Token for fleet-wide model admin routes; empty disables them
 MODEL_SERVER_URL = os.getenv("MODEL_SERVER_URL", "http://localhost:8000/generate")  # default to model server port
+# comma-separated replica list, each optionally suffixed with |weight; falls back to MODEL_SERVER_URL
+MODEL_SERVER_URLS = os.getenv("MODEL_SERVER_URLS", MODEL_SERVER_URL)
+MODEL_SERVER_DNS_DISCOVERY = os.getenv("MODEL_SERVER_DNS_DISCOVERY", "0") == "1"  # one replica per resolved IP
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))  # seconds between /ready probes
+REPLICA_EJECT_AFTER = int(os.getenv("REPLICA_EJECT_AFTER", "3"))  # consecutive failures before ejecting
+# request hedging: duplicate slow upstream calls to a second target, keep the first answer
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_TARGETS = os.getenv("HEDGE_TARGETS", "")  # comma-separated; empty = other replicas from MODEL_SERVER_URLS
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))  # hedge once the primary is slower than this
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "200"))
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.1"))  # at most ~10% extra upstream calls
+# admission control for /generate: beyond MAX_INFLIGHT running and MAX_QUEUE waiting, requests are shed
+GATEWAY_MAX_INFLIGHT = int(os.getenv("GATEWAY_MAX_INFLIGHT", "256"))  # 0 disables the limiter
+GATEWAY_MAX_QUEUE = int(os.getenv("GATEWAY_MAX_QUEUE", "512"))
+GATEWAY_QUEUE_TIMEOUT = float(os.getenv("GATEWAY_QUEUE_TIMEOUT", "10"))  # seconds a queued request may wait
+GATEWAY_RETRY_AFTER = int(os.getenv("GATEWAY_RETRY_AFTER", "1"))  # Retry-After hint on rejections
+# queued /generate requests are released in weighted-fair order across projects;
+# a project's weight is its sched_weight, or the default for its priority class
+SCHED_CLASS_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (
+        item.split("=", 1) for item in os.getenv("SCHED_CLASS_WEIGHTS", "interactive=4,bulk=1").split(",") if "=" in item
+    )
+}
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "60"))  # seconds; 0 disables the cache
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
+# upstream (model-server) HTTP pool
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "180"))  # generations can take minutes on CPU
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+# total time a /generate call may take; the model server is told to stop decoding at the same deadline
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT", str(UPSTREAM_READ_TIMEOUT)))
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))  # seconds between client disconnect checks
+# usage ledger writer
+USAGE_QUEUE_SIZE = int(os.getenv("USAGE_QUEUE_SIZE", "10000"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))  # seconds
+USAGE_RETRY_MAX_DELAY = float(os.getenv("USAGE_RETRY_MAX_DELAY", "30"))  # cap on the backoff between failed flushes of one batch
+# gateway micro-batching of single-prompt /generate calls
+GATEWAY_BATCH_ENABLED = os.getenv("GATEWAY_BATCH_ENABLED", "0") == "1"
+GATEWAY_BATCH_WINDOW_MS = float(os.getenv("GATEWAY_BATCH_WINDOW_MS", "5"))
+GATEWAY_BATCH_MAX = int(os.getenv("GATEWAY_BATCH_MAX", "16"))
+# singleflight: concurrent identical deterministic/seeded requests share one upstream call
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "1") == "1"
+# exact-match response cache (only deterministic or seeded requests are cacheable)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 0 disables
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR")  # optional disk tier
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024)))
+RESPONSE_CACHE_NAMESPACE = os.getenv("RESPONSE_CACHE_NAMESPACE", "")  # bump to invalidate after a model change
+# offline batch jobs (/jobs): low-priority workers pack prompts into large upstream batches
+JOBS_WORKERS = int(os.getenv("JOBS_WORKERS", "2"))  # 0 disables job processing
+JOBS_BATCH_SIZE = int(os.getenv("JOBS_BATCH_SIZE", "32"))  # prompts per upstream call
+JOBS_MAX_PROMPTS = int(os.getenv("JOBS_MAX_PROMPTS", "100000"))  # per job
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", "3"))  # transient upstream failures are retried
+JOBS_SCHED_WEIGHT = float(os.getenv("JOBS_SCHED_WEIGHT", "0.25"))  # fair-queueing weight of job batches
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", "1.0"))  # seconds
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -40,6 +114,19 @@ engine = sa.create_engine(DB_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# async engine for the /generate hot path (admin endpoints stay on the sync engine)
+def _async_db_url(url: str) -> str:
+    u = sa.engine.make_url(url)
+    if u.get_backend_name() == "sqlite":
+        return u.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    if u.get_backend_name() == "postgresql":
+        return u.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+    return url
+
+ASYNC_DB_URL = os.getenv("ASYNC_DB_URL") or _async_db_url(DB_URL)
+async_engine = create_async_engine(ASYNC_DB_URL)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
 class Company(Base):
     __tablename__ = "companies"
     id = sa.Column(sa.Integer, primary_key=True, index=True)
@@ -63,6 +150,8 @@ class Project(Base):
     description = sa.Column(sa.String, nullable=True)
     department = sa.Column(sa.String, nullable=True)
     status = sa.Column(sa.String, default="active")  # NEW: used by /admin/stats/projects/status
+    priority_class = sa.Column(sa.String, default="interactive")  # key into SCHED_CLASS_WEIGHTS
+    sched_weight = sa.Column(sa.Float, nullable=True)  # overrides the class weight when set
     created_at = sa.Column(sa.DateTime, server_default=sa.func.now())
     __table_args__ = (sa.UniqueConstraint("company_id", "name", name="uq_project_company_name"),)
 
@@ -94,10 +183,40 @@ class Usage(Base):
     total_tokens = sa.Column(sa.Integer)
     used_at = sa.Column(sa.DateTime, default=sa.func.now())
     latency_ms = sa.Column(sa.Integer)  # NEW
+    cache_hit = sa.Column(sa.Boolean, default=False)
     __table_args__ = (
         sa.Index("ix_usage_api_key_used_at", "api_key_id", "used_at"),
     )
 
+class BatchJob(Base):
+    __tablename__ = "batch_jobs"
+    id = sa.Column(sa.String, primary_key=True)  # uuid hex, handed to the client
+    api_key_id = sa.Column(sa.Integer, sa.ForeignKey("api_keys.id"))
+    project_id = sa.Column(sa.Integer, sa.ForeignKey("projects.id"), index=True)
+    status = sa.Column(sa.String, default="queued")  # queued|running|completed|cancelled
+    params = sa.Column(sa.JSON)  # sampling params shared by every prompt in the job
+    total = sa.Column(sa.Integer, default=0)
+    completed = sa.Column(sa.Integer, default=0)
+    failed = sa.Column(sa.Integer, default=0)
+    created_at = sa.Column(sa.DateTime, default=sa.func.now())
+    finished_at = sa.Column(sa.DateTime, nullable=True)
+
+class BatchJobItem(Base):
+    __tablename__ = "batch_job_items"
+    id = sa.Column(sa.Integer, primary_key=True)
+    job_id = sa.Column(sa.String, sa.ForeignKey("batch_jobs.id"), nullable=False)
+    idx = sa.Column(sa.Integer, nullable=False)  # position in the uploaded file
+    custom_id = sa.Column(sa.String, nullable=True)
+    prompt = sa.Column(sa.Text, nullable=False)
+    status = sa.Column(sa.String, default="pending")  # pending|running|done|failed|cancelled
+    attempts = sa.Column(sa.Integer, default=0)
+    output = sa.Column(sa.Text, nullable=True)
+    usage = sa.Column(sa.JSON, nullable=True)
+    error = sa.Column(sa.String, nullable=True)
+    __table_args__ = (
+        sa.Index("ix_job_items_job_status_idx", "job_id", "status", "idx"),
+    )
+
 Base.metadata.create_all(bind=engine)
 
 def ensure_schema(engine: Engine):
@@ -106,6 +225,15 @@ def ensure_schema(engine: Engine):
         cols = [row[1] for row in conn.execute(sa.text("PRAGMA table_info(projects)")).fetchall()]
         if "status" not in cols:
             conn.execute(sa.text("ALTER TABLE projects ADD COLUMN status VARCHAR DEFAULT 'active'"))
+        # Add projects.priority_class / sched_weight if missing (SQLite)
+        if "priority_class" not in cols:
+            conn.execute(sa.text("ALTER TABLE projects ADD COLUMN priority_class VARCHAR DEFAULT 'interactive'"))
+        if "sched_weight" not in cols:
+            conn.execute(sa.text("ALTER TABLE projects ADD COLUMN sched_weight FLOAT"))
+        # Add usage.cache_hit if missing (SQLite)
+        cols = [row[1] for row in conn.execute(sa.text("PRAGMA table_info(usage)")).fetchall()]
+        if "cache_hit" not in cols:
+            conn.execute(sa.text("ALTER TABLE usage ADD COLUMN cache_hit BOOLEAN DEFAULT 0"))
         # Ensure helpful indexes exist
         conn.execute(sa.text("CREATE INDEX IF NOT EXISTS ix_usage_api_key_used_at ON usage (api_key_id, used_at)"))
         conn.execute(sa.text("CREATE INDEX IF NOT EXISTS ix_apikey_project_revoked ON api_keys (project_id, revoked)"))
@@ -118,6 +246,10 @@ app = FastAPI(title="Fortress-stack API")
 # Prometheus metrics (keep labels low-cardinality)
 HTTP_REQS = Counter("fs_http_requests_total", "HTTP requests", ["route", "code"])
 GEN_LAT = Histogram("fs_generate_latency_seconds", "Latency of /generate")
+GEN_TTFT = Histogram(
+    "fs_generate_ttft_seconds", "Time to first streamed token on /generate",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
 
 #CORS middleware 
 app.add_middleware(
@@ -142,13 +274,69 @@ PROMPT_TOKENS = Counter("fs_prompt_tokens_total", "Prompt tokens used", ["api_ke
 COMPLETION_TOKENS = Counter("fs_completion_tokens_total", "Completion tokens used", ["api_key"])
 TOTAL_TOKENS = Counter("fs_total_tokens_total", "Total tokens used", ["api_key"])
 LAT = Histogram("fs_request_latency_seconds", "Request latency")
+UPSTREAM_PREFILL = Histogram(
+    "fs_upstream_prefill_seconds", "Model-server prefill time (prompt encode + first token) per upstream call",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+UPSTREAM_DECODE = Histogram(
+    "fs_upstream_decode_seconds", "Model-server decode time after the first token per upstream call",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+UPSTREAM_TPS = Histogram(
+    "fs_upstream_tokens_per_second", "Model-server decode throughput per upstream call",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+UPSTREAM_COMPLETION_TOKENS = Histogram(
+    "fs_upstream_completion_tokens", "Tokens generated per upstream call",
+    buckets=(1, 8, 32, 128, 256, 512, 1024, 2048, 4096),
+)
+KEY_CACHE_HITS = Counter("fs_apikey_cache_hits_total", "API key lookups served from cache")
+KEY_CACHE_MISSES = Counter("fs_apikey_cache_misses_total", "API key lookups that went to the DB")
+KEY_CACHE_EVICTIONS = Counter("fs_apikey_cache_evictions_total", "API key cache entries evicted (LRU or TTL)")
+UPSTREAM_INFLIGHT = Gauge("fs_upstream_inflight_requests", "Requests currently in flight to the model server")
+UPSTREAM_POOL_MAX = Gauge("fs_upstream_pool_max_connections", "Configured upstream connection limit")
+UPSTREAM_POOL_CONNS = Gauge("fs_upstream_pool_connections", "Open upstream connections by state", ["state"])
+REPLICA_INFLIGHT = Gauge("fs_replica_inflight_requests", "In-flight requests per model-server replica", ["replica"])
+REPLICA_LAT = Histogram(
+    "fs_replica_latency_seconds", "Upstream latency per model-server replica", ["replica"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 180),
+)
+REPLICA_ERRORS = Counter("fs_replica_errors_total", "Failed upstream calls per model-server replica", ["replica"])
+REPLICA_HEALTHY = Gauge("fs_replica_healthy", "1 if the replica is in rotation, 0 if ejected", ["replica"])
+CANCELLED = Counter("fs_cancelled_requests_total", "/generate calls abandoned before upstream finished", ["reason"])  # client_disconnect|deadline
+UPSTREAM_CANCELS = Counter("fs_upstream_cancels_total", "Abort requests sent to model-server replicas")
+HEDGES_SENT = Counter("fs_hedges_sent_total", "Duplicate upstream requests sent by the hedger")
+HEDGES_WON = Counter("fs_hedges_won_total", "Hedged requests where the duplicate answered first")
+HEDGES_THROTTLED = Counter("fs_hedges_throttled_total", "Hedges skipped because the hedging budget was spent")
+HEDGE_DELAY = Gauge("fs_hedge_delay_seconds", "Latency threshold that triggers a hedge, per request size", ["size"])  # size: prompts x max_new_tokens, rounded up to a power of two
+ADMISSION_INFLIGHT = Gauge("fs_admission_inflight", "/generate requests admitted past the gateway limiter")
+ADMISSION_QUEUE_DEPTH = Gauge("fs_admission_queue_depth", "/generate requests waiting for a gateway slot")
+ADMISSION_REJECTIONS = Counter("fs_admission_rejections_total", "/generate requests shed by the gateway", ["reason"])  # queue_full|queue_timeout
+SCHED_QUEUE_WAIT = Histogram(
+    "fs_sched_queue_wait_seconds", "Time a /generate request waited for a gateway slot", ["project", "priority_class"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+USAGE_RECORDS = Counter("fs_usage_records_total", "Usage ledger records by outcome", ["outcome"])  # queued|flushed|requeued|dropped
+USAGE_QUEUE_DEPTH = Gauge("fs_usage_queue_depth", "Usage records waiting to be written")
+USAGE_FLUSH_LAT = Histogram("fs_usage_flush_seconds", "Time to write one usage batch")
+COALESCED = Counter("fs_coalesced_requests_total", "Requests served by a shared upstream call", ["kind"])  # batched|singleflight
+RESPONSE_CACHE_LOOKUPS = Counter("fs_response_cache_lookups_total", "Response cache lookups", ["result"])  # hit|miss
+RESPONSE_CACHE_BYTES = Gauge("fs_response_cache_bytes", "Bytes held by the in-memory response cache")
+RESPONSE_CACHE_HIT_RATIO = Gauge("fs_response_cache_hit_ratio", "Response cache hits / lookups since start")
+JOB_ITEMS = Counter("fs_job_items_total", "Batch job prompts processed", ["outcome"])  # done|failed|retried
+JOB_BATCH_SIZE = Histogram("fs_job_batch_size", "Prompts per upstream call made by job workers", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+GATEWAY_BATCH_SIZE = Histogram("fs_gateway_batch_size", "Prompts per coalesced upstream call", buckets=(1, 2, 4, 8, 16, 32, 64))
 
 #pydantic models
 class GenerationRequest(BaseModel):
     prompt: list[str]
+    model: str | None = None  # model-server registry name; None = the replica's default model
     max_new_tokens: int = 4092
     temperature: float = 0.8
     top_p: float = 0.95
+    stream: bool = False
+    deterministic: bool = False  # greedy decoding upstream; makes the response cacheable
+    seed: int | None = None  # seeded sampling upstream; also cacheable
 
 class APIKeyCreate(BaseModel):
     project_id: int
@@ -158,6 +346,12 @@ class ProjectCreate(BaseModel):
     name: str
     description: str | None = None
     department: str | None = None
+    priority_class: str = "interactive"
+    sched_weight: float | None = None
+
+class ProjectScheduling(BaseModel):
+    priority_class: str = "interactive"
+    sched_weight: float | None = None
 
 class SignUpRequest(BaseModel):
     company: str
@@ -176,8 +370,17 @@ class AdminCreateUserRequest(BaseModel):
     username: str
     password: str
 
+class JobParams(BaseModel):
+    model: str | None = None
+    max_new_tokens: int = 4092
+    temperature: float = 0.8
+    top_p: float = 0.95
+    deterministic: bool = False
+
 class DownloadRequest(BaseModel):
     repo_id: str
+    revision: str = "main"
+    max_bytes_per_second: int | None = None  # None = the model server's DOWNLOAD_MAX_BYTES_PER_SECOND
 
 #auth helpers
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
@@ -231,6 +434,13 @@ def get_auth_context(
         raise HTTPException(status_code=401, detail="Unauthorized")
     return {"user": user, "company_id": int(company_id)}
 
+def require_operator(x_operator_token: str | None = Header(None)):
+    """Model-server administration acts on every tenant, so it needs the operator token, not a tenant login."""
+    if not OPERATOR_TOKEN:
+        raise HTTPException(status_code=403, detail="Operator routes are disabled (OPERATOR_TOKEN is not set)")
+    if not x_operator_token or not secrets.compare_digest(x_operator_token, OPERATOR_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid operator token")
+
 # NEW: utility to get or create a default API key for a project
 def get_or_create_api_key(db, project_id: int, name: str = "default"):
     key_obj = (
@@ -247,6 +457,888 @@ def get_or_create_api_key(db, project_id: int, name: str = "default"):
     db.refresh(api_key)
     return api_key.key
 
+#api key cache (hot path for /generate)
+class ResolvedKey(NamedTuple):
+    key_id: int
+    project_id: int
+    company_id: int
+    revoked: bool
+    priority_class: str = "interactive"
+    sched_weight: float = 1.0  # effective fair-queueing weight
+
+class APIKeyCache:
+    """Bounded LRU of raw key -> ResolvedKey with a per-entry TTL."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, ResolvedKey]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, raw_key: str) -> ResolvedKey | None:
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._entries.get(raw_key)
+            if item is None:
+                return None
+            expires_at, resolved = item
+            if expires_at < time.monotonic():
+                del self._entries[raw_key]
+                KEY_CACHE_EVICTIONS.inc()
+                return None
+            self._entries.move_to_end(raw_key)
+            return resolved
+
+    def put(self, raw_key: str, resolved: ResolvedKey):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[raw_key] = (time.monotonic() + self.ttl, resolved)
+            self._entries.move_to_end(raw_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                KEY_CACHE_EVICTIONS.inc()
+
+    def invalidate(self, raw_key: str | None):
+        if not raw_key:
+            return
+        with self._lock:
+            self._entries.pop(raw_key, None)
+
+    def invalidate_project(self, project_id: int):
+        with self._lock:
+            stale = [k for k, (_, r) in self._entries.items() if r.project_id == project_id]
+            for k in stale:
+                del self._entries[k]
+
+api_key_cache = APIKeyCache(API_KEY_CACHE_TTL, API_KEY_CACHE_SIZE)
+
+def project_weight(priority_class: str | None, sched_weight: float | None) -> float:
+    if sched_weight:
+        return sched_weight
+    return SCHED_CLASS_WEIGHTS.get(priority_class or "interactive", 1.0)
+
+def validate_scheduling(priority_class: str, sched_weight: float | None):
+    if priority_class not in SCHED_CLASS_WEIGHTS:
+        raise HTTPException(status_code=400, detail=f"priority_class must be one of {sorted(SCHED_CLASS_WEIGHTS)}")
+    if sched_weight is not None and sched_weight <= 0:
+        raise HTTPException(status_code=400, detail="sched_weight must be > 0")
+
+async def resolve_api_key(raw_key: str) -> ResolvedKey | None:
+    """Look up key -> project/company, serving from the in-process cache when possible."""
+    cached = api_key_cache.get(raw_key)
+    if cached is not None:
+        KEY_CACHE_HITS.inc()
+        return cached
+    KEY_CACHE_MISSES.inc()
+    # own short session: a request-scoped one would pin a pooled connection for the whole generation
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            sa.select(
+                APIKey.id, APIKey.project_id, APIKey.revoked,
+                Project.company_id, Project.priority_class, Project.sched_weight,
+            )
+            .join(Project, APIKey.project_id == Project.id)
+            .where(APIKey.key == raw_key)
+            .limit(1)
+        )
+        row = result.first()
+    if not row:
+        return None
+    resolved = ResolvedKey(
+        key_id=row.id,
+        project_id=row.project_id,
+        company_id=row.company_id,
+        revoked=bool(row.revoked),
+        priority_class=row.priority_class or "interactive",
+        sched_weight=project_weight(row.priority_class, row.sched_weight),
+    )
+    api_key_cache.put(raw_key, resolved)
+    return resolved
+
+#upstream http client (shared for the app lifetime)
+upstream_client: httpx.AsyncClient | None = None
+upstream_sync_client: httpx.Client | None = None
+
+def _upstream_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+    )
+
+def _upstream_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        connect=UPSTREAM_CONNECT_TIMEOUT,
+        read=UPSTREAM_READ_TIMEOUT,
+        write=UPSTREAM_WRITE_TIMEOUT,
+        pool=UPSTREAM_POOL_TIMEOUT,
+    )
+
+def _pool_connections(client) -> list:
+    # httpx keeps the httpcore pool on the transport; tolerate layout changes across versions
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    return list(getattr(pool, "connections", []) or [])
+
+def _count_upstream_connections(state: str) -> int:
+    conns = _pool_connections(upstream_client) + _pool_connections(upstream_sync_client)
+    if state == "idle":
+        return sum(1 for c in conns if c.is_idle())
+    if state == "active":
+        return sum(1 for c in conns if not c.is_idle() and not c.is_closed())
+    return len(conns)
+
+UPSTREAM_POOL_MAX.set(UPSTREAM_MAX_CONNECTIONS)
+for _state in ("active", "idle", "total"):
+    UPSTREAM_POOL_CONNS.labels(state=_state).set_function(lambda s=_state: _count_upstream_connections(s))
+
+@app.on_event("startup")
+async def open_upstream_clients():
+    global upstream_client, upstream_sync_client
+    upstream_client = httpx.AsyncClient(limits=_upstream_limits(), timeout=_upstream_timeout())
+    upstream_sync_client = httpx.Client(limits=_upstream_limits(), timeout=_upstream_timeout())
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    global upstream_client, upstream_sync_client
+    if upstream_client is not None:
+        await upstream_client.aclose()
+        upstream_client = None
+    if upstream_sync_client is not None:
+        upstream_sync_client.close()
+        upstream_sync_client = None
+
+#response cache (exact match on model + prompts + generation params)
+class ResponseCache:
+    """Byte-bounded LRU with a TTL, optionally backed by a directory of JSON files."""
+
+    def __init__(self, max_bytes: int, ttl: float, disk_dir: str | None, disk_max_bytes: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._lookups = 0
+        self._lock = threading.Lock()
+        # disk tier bookkeeping, least recently used first, so a put never has to list the directory
+        self._disk_files: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._scan_disk()
+
+    def _scan_disk(self):
+        entries = []
+        for path in self.disk_dir.glob("*.json"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk_files[key] = size
+            self._disk_bytes += size
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.ttl > 0
+
+    @staticmethod
+    def key_for(request: GenerationRequest) -> str:
+        params = request.dict(exclude={"stream"})
+        # a hot swap changes the epoch, so outputs of the replaced weights are never served again
+        raw = json.dumps([RESPONSE_CACHE_NAMESPACE, replica_pool.model_epoch(), params], sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def cacheable(request: GenerationRequest) -> bool:
+        return not request.stream and (request.deterministic or request.seed is not None)
+
+    async def get(self, key: str) -> dict | None:
+        value = self._get_memory(key)
+        if value is None and self.disk_dir:
+            value = await asyncio.to_thread(self._get_disk, key)
+            if value is not None:
+                self._put_memory(key, value[0], value[1])
+                value = value[1]
+        self._record(value is not None)
+        return json.loads(value) if value is not None else None
+
+    async def put(self, key: str, data: dict):
+        blob = json.dumps(data).encode()
+        expires_at = time.time() + self.ttl
+        self._put_memory(key, expires_at, blob)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._put_disk, key, expires_at, blob)
+            except OSError as e:
+                # the response is already generated and billed; a cache write must never fail it
+                print("Response cache disk write failed:", e)
+
+    def _record(self, hit: bool):
+        RESPONSE_CACHE_LOOKUPS.labels(result="hit" if hit else "miss").inc()
+        with self._lock:
+            self._lookups += 1
+            self._hits += int(hit)
+            RESPONSE_CACHE_HIT_RATIO.set(self._hits / self._lookups)
+
+    def _get_memory(self, key: str) -> bytes | None:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def _put_memory(self, key: str, expires_at: float, blob: bytes):
+        if len(blob) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, blob)
+            self._bytes += len(blob)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+            RESPONSE_CACHE_BYTES.set(self._bytes)
+
+    def _drop(self, key: str):
+        _, blob = self._entries.pop(key)
+        self._bytes -= len(blob)
+        RESPONSE_CACHE_BYTES.set(self._bytes)
+
+    def _get_disk(self, key: str) -> tuple[float, bytes] | None:
+        path = self.disk_dir / f"{key}.json"
+        try:
+            raw = path.read_bytes()
+        except OSError:
+            return None
+        expires_line, _, blob = raw.partition(b"\n")
+        try:
+            expires_at = float(expires_line)
+        except ValueError:
+            expires_at = None  # truncated or corrupt file: treat as a miss
+        if expires_at is None or expires_at < time.time():
+            self._remove_disk(key)
+            return None
+        with self._disk_lock:
+            if key in self._disk_files:
+                self._disk_files.move_to_end(key)
+        try:
+            os.utime(path)  # keeps the LRU order across restarts
+        except OSError:
+            pass
+        return expires_at, blob
+
+    def _put_disk(self, key: str, expires_at: float, blob: bytes):
+        path = self.disk_dir / f"{key}.json"
+        data = f"{expires_at}\n".encode() + blob
+        tmp = path.with_name(f"{key}.{uuid.uuid4().hex}.tmp")  # concurrent puts of one key must not share a tmp file
+        try:
+            tmp.write_bytes(data)
+            tmp.replace(path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            raise
+        evict = []
+        with self._disk_lock:
+            self._disk_bytes += len(data) - self._disk_files.pop(key, 0)
+            self._disk_files[key] = len(data)
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk_files) > 1:
+                old, size = self._disk_files.popitem(last=False)
+                self._disk_bytes -= size
+                evict.append(old)
+        for old in evict:
+            (self.disk_dir / f"{old}.json").unlink(missing_ok=True)
+
+    def _remove_disk(self, key: str):
+        with self._disk_lock:
+            self._disk_bytes -= self._disk_files.pop(key, 0)
+        try:
+            (self.disk_dir / f"{key}.json").unlink(missing_ok=True)
+        except OSError:
+            pass
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DIR, RESPONSE_CACHE_DISK_MAX_BYTES)
+
+#usage ledger writer (keeps SQLite commits off the request path)
+class UsageWriter:
+    """Drains usage records from a bounded queue and writes them in batches.
+
+    A batch that fails to write is retried with backoff ahead of newer records; it counts against
+    max_queue, so a long database outage sheds the newest records rather than growing without bound.
+    """
+
+    _STOP = None  # sentinel queued by stop(); everything ahead of it is still flushed
+
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+        self._retry: list[dict] = []  # the last batch that failed to write, retried before the queue
+        self._backoff = 0.0
+        self._stopping: asyncio.Event | None = None
+
+    def start(self):
+        # bound is enforced in submit() so the stop sentinel always fits
+        self._queue = asyncio.Queue()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def submit(self, record: dict) -> bool:
+        """Enqueue one usage record without blocking; drops it if the queue is full."""
+        if self._task is None or self._queue.qsize() + len(self._retry) >= self.max_queue:
+            USAGE_RECORDS.labels(outcome="dropped").inc()
+            return False
+        self._queue.put_nowait(record)
+        USAGE_RECORDS.labels(outcome="queued").inc()
+        USAGE_QUEUE_DEPTH.set(self._queue.qsize())
+        return True
+
+    async def stop(self):
+        """Stop accepting work and wait until everything queued has been written."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._stopping.set()  # cut short any retry backoff
+        self._queue.put_nowait(self._STOP)
+        await task
+        USAGE_QUEUE_DEPTH.set(0)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch, self._retry = self._retry, []
+            if not batch:
+                first = await self._queue.get()
+                if first is self._STOP:
+                    return
+                batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            USAGE_QUEUE_DEPTH.set(self._queue.qsize())
+            if await self._flush(batch):
+                self._backoff = 0.0
+            elif stopping or self._task is None:
+                # shutting down: one attempt per batch, so a dead database cannot hang shutdown
+                USAGE_RECORDS.labels(outcome="dropped").inc(len(batch))
+            else:
+                await self._requeue(batch)
+
+    async def _flush(self, batch: list[dict]) -> bool:
+        try:
+            with USAGE_FLUSH_LAT.time():
+                await write_usage_batch(batch)
+        except Exception as e:
+            print("Usage flush failed:", e)
+            return False
+        USAGE_RECORDS.labels(outcome="flushed").inc(len(batch))
+        return True
+
+    async def _requeue(self, batch: list[dict]):
+        """Keep a failed batch for the next attempt, within max_queue, and back off."""
+        overflow = len(batch) + self._queue.qsize() - self.max_queue
+        if overflow > 0:
+            USAGE_RECORDS.labels(outcome="dropped").inc(overflow)
+            batch = batch[:-overflow]
+        self._retry = batch
+        USAGE_RECORDS.labels(outcome="requeued").inc(len(batch))
+        self._backoff = min(max(self._backoff * 2, 0.5), USAGE_RETRY_MAX_DELAY)
+        try:
+            await asyncio.wait_for(self._stopping.wait(), self._backoff)
+        except asyncio.TimeoutError:
+            pass
+
+async def write_usage_batch(batch: list[dict]):
+    """One transaction: multi-row usage insert plus one stats upsert per key."""
+    per_key: dict[int, dict] = {}
+    for r in batch:
+        agg = per_key.setdefault(r["api_key_id"], {"k": r["api_key_id"], "n": 0, "t": r["used_at"]})
+        agg["n"] += 1
+        agg["t"] = max(agg["t"], r["used_at"])
+    async with async_engine.begin() as conn:
+        await conn.execute(sa.insert(Usage).values(batch))
+        await conn.execute(
+            sa.text("""
+            INSERT INTO api_key_stats (api_key_id, request_count, last_used_at)
+            VALUES (:k, :n, :t)
+            ON CONFLICT(api_key_id) DO UPDATE SET
+                request_count = api_key_stats.request_count + excluded.request_count,
+                last_used_at = excluded.last_used_at
+            """),
+            list(per_key.values()),
+        )
+
+usage_writer = UsageWriter(USAGE_QUEUE_SIZE, USAGE_BATCH_SIZE, USAGE_FLUSH_INTERVAL)
+
+@app.on_event("startup")
+async def start_usage_writer():
+    usage_writer.start()
+
+@app.on_event("shutdown")
+async def stop_usage_writer():
+    # job workers record usage, so they have to stop before the writer drains
+    await job_runner.stop()
+    await usage_writer.stop()
+    # after the writer has drained, nothing else uses the async engine
+    await async_engine.dispose()
+
+#model-server replica pool (least-loaded routing with health-based ejection)
+class Replica:
+    def __init__(self, url: str, weight: float = 1.0, healthy: bool = True):
+        self.url = url
+        self.weight = weight
+        self.inflight = 0
+        self.healthy = healthy
+        self.failures = 0
+        self.last_latency_ms: int | None = None
+        self.model_versions: dict[str, str] = {}  # hot-swapped models, as reported by /ready
+        REPLICA_HEALTHY.labels(replica=url).set(int(healthy))
+
+    @property
+    def ready_url(self) -> str:
+        # /ready only answers 200 once the replica's model is loaded and warmed up
+        return self.url.replace("/generate", "/ready")
+
+    def cancel_url(self, request_id: str) -> str:
+        return self.url.replace("/generate", f"/cancel/{request_id}")
+
+    def api_url(self, path: str) -> str:
+        return self.url.replace("/generate", path)
+
+    def load(self) -> float:
+        return (self.inflight + 1) / self.weight
+
+class ReplicaPool:
+    def __init__(self, spec: str, dns_discovery: bool):
+        self.templates = self._parse(spec)
+        self.dns_discovery = dns_discovery
+        self.replicas: list[Replica] = [Replica(url, w) for url, w in self.templates]
+        self.extra: list[Replica] = []  # probed for health but not routed to (e.g. hedge targets)
+        self._probe_task: asyncio.Task | None = None
+
+    @staticmethod
+    def _parse(spec: str) -> list[tuple[str, float]]:
+        out = []
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            url, _, weight = item.partition("|")
+            out.append((url.strip(), float(weight) if weight else 1.0))
+        return out
+
+    def pick(self, exclude: set[str] | None = None) -> Replica:
+        candidates = [r for r in self.replicas if r.healthy and r.url not in (exclude or ())]
+        if not candidates:
+            # everything is ejected: fail open rather than refusing all traffic
+            candidates = [r for r in self.replicas if r.url not in (exclude or ())] or self.replicas
+        best = min(r.load() for r in candidates)
+        return random.choice([r for r in candidates if r.load() == best])
+
+    def acquire(self, replica: Replica):
+        replica.inflight += 1
+        REPLICA_INFLIGHT.labels(replica=replica.url).set(replica.inflight)
+
+    def release(self, replica: Replica, elapsed: float, ok: bool | None):
+        """ok=None means the call was abandoned (e.g. a cancelled hedge) and says nothing about health."""
+        replica.inflight -= 1
+        REPLICA_INFLIGHT.labels(replica=replica.url).set(replica.inflight)
+        if ok is None:
+            return
+        REPLICA_LAT.labels(replica=replica.url).observe(elapsed)
+        if ok:
+            replica.failures = 0
+        else:
+            REPLICA_ERRORS.labels(replica=replica.url).inc()
+            self._mark_failure(replica)
+
+    def _mark_failure(self, replica: Replica):
+        replica.failures += 1
+        if replica.failures >= REPLICA_EJECT_AFTER and replica.healthy:
+            replica.healthy = False
+            REPLICA_HEALTHY.labels(replica=replica.url).set(0)
+
+    def _mark_unready(self, replica: Replica):
+        """The replica said it is still loading: take it out now rather than after repeated failures."""
+        replica.failures = max(replica.failures, REPLICA_EJECT_AFTER)
+        if replica.healthy:
+            replica.healthy = False
+            REPLICA_HEALTHY.labels(replica=replica.url).set(0)
+
+    def _mark_success(self, replica: Replica):
+        replica.failures = 0
+        if not replica.healthy:
+            replica.healthy = True
+            REPLICA_HEALTHY.labels(replica=replica.url).set(1)
+
+    async def _discover(self):
+        loop = asyncio.get_running_loop()
+        urls: list[tuple[str, float]] = []
+        for url, weight in self.templates:
+            parts = urlsplit(url)
+            try:
+                infos = await loop.getaddrinfo(parts.hostname, parts.port, type=socket.SOCK_STREAM)
+            except OSError:
+                continue
+            for ip in sorted({info[4][0] for info in infos}):
+                netloc = f"{ip}:{parts.port}" if parts.port else ip
+                urls.append((urlunsplit(parts._replace(netloc=netloc)), weight))
+        if not urls:
+            return
+        existing = {r.url: r for r in self.replicas}
+        # newly discovered replicas (scale-ups) get no traffic until their first /ready probe passes
+        self.replicas = [existing.get(url) or Replica(url, w, healthy=False) for url, w in urls]
+        for url in existing.keys() - {u for u, _ in urls}:
+            REPLICA_HEALTHY.labels(replica=url).set(0)
+
+    async def probe_once(self):
+        if self.dns_discovery:
+            await self._discover()
+        for replica in self.replicas + self.extra:
+            t0 = time.time()
+            try:
+                r = await upstream_client.get(replica.ready_url, timeout=REPLICA_HEALTH_INTERVAL)
+                status = r.status_code
+            except httpx.HTTPError:
+                status = None
+            if status == 200:
+                replica.last_latency_ms = int((time.time() - t0) * 1000)
+                try:
+                    replica.model_versions = r.json().get("model_versions") or {}
+                except ValueError:
+                    pass
+                self._mark_success(replica)
+            elif status == 503:
+                self._mark_unready(replica)
+            else:
+                self._mark_failure(replica)
+
+    def model_epoch(self) -> str:
+        """Changes whenever a replica serves hot-swapped weights; "" while every model is on its startup weights."""
+        versions = sorted({(name, v) for r in self.replicas for name, v in r.model_versions.items()})
+        if not versions:
+            return ""
+        return hashlib.sha256(json.dumps(versions).encode()).hexdigest()[:16]
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await self.probe_once()
+            except Exception as e:
+                print("Replica probe failed:", e)
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+
+    def start(self):
+        self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def snapshot(self) -> list[dict]:
+        return [
+            {
+                "url": r.url,
+                "weight": r.weight,
+                "healthy": r.healthy,
+                "inflight": r.inflight,
+                "latency_ms": r.last_latency_ms,
+            }
+            for r in self.replicas
+        ]
+
+replica_pool = ReplicaPool(MODEL_SERVER_URLS, MODEL_SERVER_DNS_DISCOVERY)
+
+@app.on_event("startup")
+async def start_replica_probes():
+    replica_pool.start()
+
+@app.on_event("shutdown")
+async def stop_replica_probes():
+    await replica_pool.stop()
+
+#request hedging
+class Hedger:
+    """Sends a duplicate upstream call when the primary is slower than the recent latency percentile.
+
+    /generate only answers once generation is done, so latency scales with the work asked for;
+    samples and thresholds are kept per size bucket (prompts x max_new_tokens, powers of two).
+    """
+
+    _min_samples = 20  # no hedging for a size until its percentile means something
+
+    def __init__(self, targets: str, percentile: float, min_delay_ms: float, budget_ratio: float):
+        self.targets = [Replica(url, w) for url, w in ReplicaPool._parse(targets)]
+        self.percentile = percentile
+        self.min_delay = min_delay_ms / 1000.0
+        self.budget_ratio = budget_ratio
+        self._latency: dict[int, deque[float]] = {}
+        # token bucket: each request earns budget_ratio tokens, each hedge spends one
+        self._max_tokens = 10.0
+        self._tokens = self._max_tokens
+
+    @staticmethod
+    def size_bucket(payload: dict) -> int:
+        work = len(payload.get("prompt") or ()) * int(payload.get("max_new_tokens") or 1)
+        return max(work - 1, 0).bit_length()
+
+    def observe(self, bucket: int, seconds: float):
+        self._latency.setdefault(bucket, deque(maxlen=200)).append(seconds)
+
+    def delay(self, bucket: int) -> float | None:
+        samples = self._latency.get(bucket)
+        if not samples or len(samples) < self._min_samples:
+            return None
+        ordered = sorted(samples)
+        value = ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+        return max(self.min_delay, value)
+
+    def _pick_target(self, primary: Replica) -> Replica | None:
+        if self.targets:
+            candidates = [t for t in self.targets if t.url != primary.url and t.healthy]
+            return min(candidates, key=lambda r: r.load()) if candidates else None
+        if len(replica_pool.replicas) < 2:
+            return None
+        target = replica_pool.pick(exclude={primary.url})
+        return None if target is primary else target
+
+    async def _timed(self, bucket: int, replica: Replica, payload: dict, headers: dict) -> httpx.Response:
+        t0 = time.time()
+        resp = await upstream_attempt(replica, payload, headers)
+        if 200 <= resp.status_code < 300:
+            self.observe(bucket, time.time() - t0)
+        return resp
+
+    async def run(self, primary: Replica, payload: dict, headers: dict) -> httpx.Response:
+        self._tokens = min(self._max_tokens, self._tokens + self.budget_ratio)
+        bucket = self.size_bucket(payload)
+        delay = self.delay(bucket)
+        primary_task = asyncio.create_task(self._timed(bucket, primary, payload, headers))
+        if delay is None:
+            return await primary_task
+        HEDGE_DELAY.labels(size=str(1 << bucket)).set(delay)
+        tasks = {primary_task}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return primary_task.result()
+            target = self._pick_target(primary)
+            if target is None:
+                return await primary_task
+            if self._tokens < 1.0:
+                HEDGES_THROTTLED.inc()
+                return await primary_task
+            self._tokens -= 1.0
+            HEDGES_SENT.inc()
+            hedge_task = asyncio.create_task(self._timed(bucket, target, payload, headers))
+            tasks.add(hedge_task)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # only a success wins: a fast 429 from a busy hedge target must not beat a primary still generating
+                    if task.exception() is None and 200 <= task.result().status_code < 300:
+                        if task is hedge_task:
+                            HEDGES_WON.inc()
+                        return task.result()
+            # neither succeeded: answer as if there had been no hedge
+            return primary_task.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+hedger = Hedger(HEDGE_TARGETS, HEDGE_PERCENTILE, HEDGE_MIN_DELAY_MS, HEDGE_BUDGET_RATIO)
+replica_pool.extra = hedger.targets
+
+class AdmissionLimiter:
+    """Bounds concurrent /generate work in the gateway; once the wait queue is full, requests fail fast.
+
+    Waiters are released in weighted fair queueing order: each gets a virtual finish tag of
+    max(now, its flow's last tag) + cost / weight, and the smallest tag goes next, so a
+    flow flooding the queue only delays its own requests. A flow is a project's interactive
+    traffic by default; batch jobs pass their own flow so they never queue ahead of it.
+    """
+
+    def __init__(self, max_inflight: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.enabled = max_inflight > 0
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._inflight = 0
+        self._waiting = 0
+        self._heap: list[tuple[float, int, asyncio.Future]] = []
+        self._last_tag: dict[object, float] = {}  # flow -> finish tag of its newest waiter
+        self._vtime = 0.0
+        self._seq = itertools.count()
+
+    def _reject(self, status_code: int, reason: str, detail: str, route: str | None):
+        ADMISSION_REJECTIONS.labels(reason=reason).inc()
+        if route is not None:
+            HTTP_REQS.labels(route=route, code=str(status_code)).inc()
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    async def acquire(self, key: ResolvedKey, cost: float = 1.0, flow=None, route: str | None = "/generate"):
+        """Wait for a slot; `route` labels HTTP rejections (None for work that isn't an HTTP request)."""
+        if not self.enabled:
+            return
+        wait = SCHED_QUEUE_WAIT.labels(project=str(key.project_id), priority_class=key.priority_class)
+        if self._inflight < self.max_inflight and self._waiting == 0:
+            self._inflight += 1
+            ADMISSION_INFLIGHT.set(self._inflight)
+            wait.observe(0)
+            return
+        if self._waiting >= self.max_queue:
+            self._reject(429, "queue_full", "Gateway is at capacity, retry later", route)
+        flow = key.project_id if flow is None else flow
+        tag = max(self._vtime, self._last_tag.get(flow, 0.0)) + cost / key.sched_weight
+        self._last_tag[flow] = tag
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (tag, next(self._seq), fut))
+        self._waiting += 1
+        ADMISSION_QUEUE_DEPTH.set(self._waiting)
+        t0 = time.time()
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject(503, "queue_timeout", "Timed out waiting for a gateway slot", route)
+        except asyncio.CancelledError:
+            # the slot may have been handed over just as the client went away
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+        finally:
+            self._waiting -= 1
+            ADMISSION_QUEUE_DEPTH.set(self._waiting)
+            if self._waiting == 0:
+                self._last_tag.clear()
+        wait.observe(time.time() - t0)
+
+    def release(self):
+        """Hand the slot to the waiter with the smallest finish tag, or free it."""
+        if not self.enabled:
+            return
+        while self._heap:
+            tag, _, fut = heapq.heappop(self._heap)
+            if fut.done():  # timed out or cancelled while queued
+                continue
+            self._vtime = tag
+            fut.set_result(None)
+            return
+        self._inflight -= 1
+        ADMISSION_INFLIGHT.set(self._inflight)
+
+admission = AdmissionLimiter(GATEWAY_MAX_INFLIGHT, GATEWAY_MAX_QUEUE, GATEWAY_QUEUE_TIMEOUT, GATEWAY_RETRY_AFTER)
+
+def upstream_ok(resp: httpx.Response) -> bool:
+    """5xx counts against a replica, except a 503 that is shedding load (it carries Retry-After)."""
+    return resp.status_code < 500 or (resp.status_code == 503 and "retry-after" in resp.headers)
+
+def upstream_error(resp: httpx.Response) -> HTTPException:
+    try:
+        err = resp.json()
+    except Exception:
+        err = {"detail": resp.text}
+    headers = {"Retry-After": resp.headers["retry-after"]} if "retry-after" in resp.headers else None
+    return HTTPException(status_code=resp.status_code, detail=err.get("detail", "Upstream error"), headers=headers)
+
+_cancel_tasks: set[asyncio.Task] = set()
+
+def upstream_headers(headers: dict) -> tuple[str, dict]:
+    """Tag an upstream call with an id it can be cancelled by and the deadline it must meet."""
+    request_id = uuid.uuid4().hex
+    return request_id, {"x-request-timeout": str(GENERATE_TIMEOUT), **headers, "x-request-id": request_id}
+
+def cancel_upstream(replica: Replica, request_id: str):
+    """Fire-and-forget POST /cancel so the replica stops decoding for a caller that has gone."""
+    async def send():
+        try:
+            await upstream_client.post(replica.cancel_url(request_id), timeout=UPSTREAM_CONNECT_TIMEOUT)
+        except Exception:
+            pass  # best effort: the replica still stops at the deadline it was given
+    UPSTREAM_CANCELS.inc()
+    task = asyncio.create_task(send())
+    _cancel_tasks.add(task)
+    task.add_done_callback(_cancel_tasks.discard)
+
+async def run_cancellable(http_request: Request, coro, timeout: float):
+    """Await coro, cancelling it when the client disconnects or the deadline passes."""
+    task = asyncio.ensure_future(coro)
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                CANCELLED.labels(reason="deadline").inc()
+                raise HTTPException(status_code=504, detail="Generation deadline exceeded")
+            done, _ = await asyncio.wait({task}, timeout=min(DISCONNECT_POLL_INTERVAL, remaining))
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                CANCELLED.labels(reason="client_disconnect").inc()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
+async def upstream_attempt(replica: Replica, payload: dict, headers: dict) -> httpx.Response:
+    """One POST to one replica, body fully read."""
+    request_id, headers = upstream_headers(headers)
+    replica_pool.acquire(replica)
+    t0 = time.time()
+    ok = None
+    try:
+        with UPSTREAM_INFLIGHT.track_inprogress():
+            req = upstream_client.build_request("POST", replica.url, json=payload, headers=headers)
+            resp = await upstream_client.send(req, stream=True)
+            try:
+                await resp.aread()
+            finally:
+                await resp.aclose()
+        ok = upstream_ok(resp)
+        return resp
+    except httpx.RequestError:
+        ok = False
+        raise
+    except asyncio.CancelledError:
+        # lost a hedge race, or every caller went away
+        cancel_upstream(replica, request_id)
+        raise
+    finally:
+        replica_pool.release(replica, time.time() - t0, ok)
+
 APP_START_TIME = time.time()
 
 #admin endpoints
@@ -333,11 +1425,14 @@ def create_project(
         .first()
     ):
         raise HTTPException(status_code=409, detail="Project name already exists")
+    validate_scheduling(data.priority_class, data.sched_weight)
     project = Project(
         company_id=ctx["company_id"],
         name=data.name,
         description=data.description,
         department=data.department,  # <— save it
+        priority_class=data.priority_class,
+        sched_weight=data.sched_weight,
     )
     db.add(project)
     db.commit()
@@ -347,9 +1442,34 @@ def create_project(
         "name": project.name,
         "description": project.description,
         "department": project.department,
+        "priority_class": project.priority_class,
+        "sched_weight": project.sched_weight,
         "created_at": project.created_at,
     }
 
+# Change a project's share of gateway capacity under contention
+@app.put("/admin/project/{project_id}/scheduling")
+def update_project_scheduling(
+    project_id: int,
+    data: ProjectScheduling,
+    ctx=Depends(get_auth_context),
+    db: Session = Depends(get_db),
+):
+    project = db.query(Project).filter(Project.id == project_id).first()
+    if not project or project.company_id != ctx["company_id"]:
+        raise HTTPException(status_code=404, detail="Project not found")
+    validate_scheduling(data.priority_class, data.sched_weight)
+    project.priority_class = data.priority_class
+    project.sched_weight = data.sched_weight
+    db.commit()
+    api_key_cache.invalidate_project(project_id)
+    return {
+        "id": project.id,
+        "priority_class": project.priority_class,
+        "sched_weight": project.sched_weight,
+        "effective_weight": project_weight(project.priority_class, project.sched_weight),
+    }
+
 @app.delete("/admin/project/{project_id}")
 def delete_project(
     project_id: int,
@@ -365,11 +1485,17 @@ def delete_project(
         db.query(APIKey.id).filter(APIKey.project_id == project.id)
     )).delete(synchronize_session=False)
     
+    db.query(BatchJobItem).filter(BatchJobItem.job_id.in_(
+        db.query(BatchJob.id).filter(BatchJob.project_id == project.id)
+    )).delete(synchronize_session=False)
+    db.query(BatchJob).filter(BatchJob.project_id == project.id).delete(synchronize_session=False)
+
     db.query(APIKey).filter(APIKey.project_id == project.id).delete(synchronize_session=False)
     
     # Delete the project itself
     db.delete(project)
     db.commit()
+    api_key_cache.invalidate_project(project_id)
     
     return {"status": "deleted", "project_id": project_id}
 
@@ -393,6 +1519,8 @@ def list_projects(
             Project.created_at,
             Project.company_id,
             getattr(Project, "department", None).label("department"),
+            Project.priority_class,
+            Project.sched_weight,
             key_count_subq.label("key_count"),
         )
         .filter(Project.company_id == ctx["company_id"])
@@ -405,6 +1533,8 @@ def list_projects(
             "name": r.name,
             "description": r.description,
             "department": r.department,
+            "priority_class": r.priority_class or "interactive",
+            "sched_weight": r.sched_weight,
             "created_at": r.created_at,
             "key_count": r.key_count,
         }
@@ -482,6 +1612,7 @@ def revoke_api_key(
         return {"id": key.id, "revoked": True}
     key.revoked = True
     db.commit()
+    api_key_cache.invalidate(key.key)
     return {"id": key.id, "revoked": True}
 
 @app.post("/admin/apikey/{key_id}/restore")
@@ -502,48 +1633,72 @@ def restore_api_key(
         return {"id": key.id, "revoked": False}
     key.revoked = False
     db.commit()
+    api_key_cache.invalidate(key.key)
     return {"id": key.id, "revoked": False}
 
 #main endpoint for generation
 @app.post("/generate")
-async def generate(request: GenerationRequest, x_api_key: str = Header(None), db: Session = Depends(get_db)):
+async def generate(
+    request: GenerationRequest,
+    http_request: Request,
+    x_api_key: str = Header(None),
+):
     start = time.time()
     if not x_api_key: 
         raise HTTPException(status_code=400, detail="API key missing")
-    key = db.query(APIKey).filter(APIKey.key == x_api_key, APIKey.revoked == False).first()
-    if not key:
+    key = await resolve_api_key(x_api_key)
+    if not key or key.revoked:
         raise HTTPException(status_code=403, detail="Invalid or revoked API key")
 
-    # project/company for metadata
-    project = db.query(Project).filter(Project.id == key.project_id).first()
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-
-    labels_id = str(key.id)
+    labels_id = str(key.key_id)
     REQS.labels(api_key=labels_id).inc()
     start_time = time.time()
 
     meta_headers = {
-        "x-company-id": str(project.company_id),
-        "x-project-id": str(project.id),
-        "x-api-key-id": str(key.id),
+        "x-company-id": str(key.company_id),
+        "x-project-id": str(key.project_id),
+        "x-api-key-id": str(key.key_id),
     }
 
+    cache_key = None
+    if not request.stream and response_cache.enabled and ResponseCache.cacheable(request):
+        cache_key = ResponseCache.key_for(request)
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            record_usage(key, cached.get("usage", {}), start, cache_hit=True)
+            HTTP_REQS.labels(route="/generate", code="200").inc()
+            GEN_LAT.observe(time.time() - start)
+            return {**cached, "cached": True}
+
+    if request.stream:
+        # cache hits above are cheap; only upstream work needs an admission slot
+        await admission.acquire(key, cost=len(request.prompt))
+        try:
+            resp = await open_upstream_stream(request.dict(), meta_headers)
+        except BaseException:
+            admission.release()
+            raise
+        return UpstreamRelay(resp, key, start, on_done=admission.release).response()
+
+    async def run_upstream() -> dict:
+        await admission.acquire(key, cost=len(request.prompt))
+        try:
+            if GATEWAY_BATCH_ENABLED and len(request.prompt) == 1 and request.seed is None:
+                return await coalescer.submit(request, meta_headers)
+            return await call_upstream(request.dict(), meta_headers)
+        finally:
+            admission.release()
+
+    async def run() -> tuple[dict, bool]:
+        if SINGLEFLIGHT_ENABLED and ResponseCache.cacheable(request):
+            return await singleflight.do(cache_key or ResponseCache.key_for(request), run_upstream)
+        return await run_upstream(), False
+
     try:
-        async with httpx.AsyncClient(timeout=180.0) as client:  # <-- Set timeout to 3 minutes (180 seconds)
-            resp = await client.post(MODEL_SERVER_URL, json=request.dict(), headers=meta_headers)
-        LAT.observe(time.time() - start_time)
-        if resp.status_code >= 400:
-            try:
-                err = resp.json()
-            except Exception:
-                err = {"detail": resp.text}
-            raise HTTPException(status_code=resp.status_code, detail=err.get("detail", "Upstream error"))
-        data = resp.json()
-        print("LLM response:", data)  # Debug log
-    except httpx.RequestError as e:
+        # a disconnect or the deadline cancels run(), which tells the replica to stop decoding
+        data, shared = await run_cancellable(http_request, run(), GENERATE_TIMEOUT)
+    finally:
         LAT.observe(time.time() - start_time)
-        raise HTTPException(status_code=502, detail=f"Model server not reachable: {e}") from e
 
     text = (
         data.get("generated_text")
@@ -553,41 +1708,661 @@ async def generate(request: GenerationRequest, x_api_key: str = Header(None), db
         or ""
     )
     usage_info = data.get("usage", {})
-
-    # Update Prometheus counters
-    PROMPT_TOKENS.labels(api_key=labels_id).inc(usage_info.get("prompt_tokens", 0))
-    COMPLETION_TOKENS.labels(api_key=labels_id).inc(usage_info.get("completion_tokens", 0))
-    TOTAL_TOKENS.labels(api_key=labels_id).inc(usage_info.get("total_tokens", 0))
-
-    # Log usage in DB
-    elapsed_ms = int((time.time() - start) * 1000)
-    usage_entry = Usage(
-        api_key_id=key.id,
-        prompt_tokens=(usage_info or {}).get("prompt_tokens"),
-        completion_tokens=(usage_info or {}).get("completion_tokens"),
-        total_tokens=(usage_info or {}).get("total_tokens"),
-        used_at=sa.func.now(),
-        latency_ms=elapsed_ms,  # NEW
-    )
-    db.add(usage_entry)
-    # Upsert per-key request counter
-    db.execute(
-        sa.text("""
-        INSERT INTO api_key_stats (api_key_id, request_count, last_used_at)
-        VALUES (:k, 1, CURRENT_TIMESTAMP)
-        ON CONFLICT(api_key_id) DO UPDATE SET
-            request_count = api_key_stats.request_count + 1,
-            last_used_at = CURRENT_TIMESTAMP
-        """),
-        {"k": key.id},
-    )
-    db.commit()
+    # every caller is billed; a shared result is flagged like a cache hit since it cost no extra compute
+    record_usage(key, usage_info, start, cache_hit=shared)
+    if cache_key is not None and not shared:
+        await response_cache.put(cache_key, {"generated_text": text, "usage": usage_info})
 
     # Respond with upstream data
     HTTP_REQS.labels(route="/generate", code="200").inc()
     GEN_LAT.observe(time.time() - start)
     return {"generated_text": text, "usage": usage_info}
 
+async def call_upstream(payload: dict, headers: dict, hedge: bool = True) -> dict:
+    """POST to the model server and return its JSON body; upstream failures become HTTPExceptions."""
+    replica = replica_pool.pick()
+    try:
+        if HEDGE_ENABLED and hedge:
+            resp = await hedger.run(replica, payload, headers)
+        else:
+            resp = await upstream_attempt(replica, payload, headers)
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Model server not reachable: {e}") from e
+    if resp.status_code >= 400:
+        raise upstream_error(resp)
+    data = resp.json()
+    observe_upstream_usage(data.get("usage"))
+    return data
+
+class SingleFlight:
+    """Callers with the same key share one in-flight call; it is cancelled once every caller has gone."""
+
+    class _Call:
+        def __init__(self, task: asyncio.Task):
+            self.task = task
+            self.waiters = 0
+
+    def __init__(self):
+        self._calls: dict[str, SingleFlight._Call] = {}
+
+    async def do(self, key: str, fn) -> tuple[dict, bool]:
+        """Returns (result, shared); shared is False only for the caller that started the call."""
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = self._calls[key] = self._Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            COALESCED.labels(kind="singleflight").inc()
+        call.waiters += 1
+        try:
+            # shielded so one caller disconnecting does not cancel the others' result
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: str, call: "SingleFlight._Call"):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+singleflight = SingleFlight()
+
+def observe_upstream_usage(usage: dict | None):
+    """Throughput histograms from the timing fields the model server reports in its usage block."""
+    usage = usage or {}
+    if usage.get("prefill_ms") is not None:
+        UPSTREAM_PREFILL.observe(usage["prefill_ms"] / 1000)
+    if usage.get("decode_ms") is not None:
+        UPSTREAM_DECODE.observe(usage["decode_ms"] / 1000)
+    if usage.get("tokens_per_second") is not None:
+        UPSTREAM_TPS.observe(usage["tokens_per_second"])
+    if usage.get("completion_tokens") is not None:
+        UPSTREAM_COMPLETION_TOKENS.observe(usage["completion_tokens"])
+
+def split_usage(usage: dict, index: int, count: int) -> dict:
+    """Slice one prompt's share out of a batched upstream usage block."""
+    per_prompt = usage.get("per_prompt")
+    if isinstance(per_prompt, list) and len(per_prompt) == count:
+        return {**{k: v for k, v in usage.items() if k != "per_prompt"}, **per_prompt[index], "prompt_count": 1}
+    return {k: v for k, v in usage.items() if k not in ("prompt_tokens", "completion_tokens", "total_tokens")} | {"prompt_count": 1}
+
+class UpstreamCoalescer:
+    """Merges concurrent single-prompt requests with identical sampling params into one upstream call."""
+
+    def __init__(self, window_ms: float, max_batch: int):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._pending: dict[tuple, list[tuple[str, dict, asyncio.Future]]] = {}
+
+    async def submit(self, request: GenerationRequest, headers: dict) -> dict:
+        key = (request.model, request.max_new_tokens, request.temperature, request.top_p, request.deterministic)
+        fut = asyncio.get_running_loop().create_future()
+        bucket = self._pending.setdefault(key, [])
+        bucket.append((request.prompt[0], headers, fut))
+        if len(bucket) == 1:
+            asyncio.get_running_loop().call_later(self.window, self._dispatch, key, bucket)
+        if len(bucket) >= self.max_batch:
+            self._dispatch(key, bucket)
+        return await fut
+
+    def _dispatch(self, key: tuple, bucket: list):
+        # the timer may fire for a bucket that already went out because it filled up
+        if self._pending.get(key) is not bucket:
+            return
+        del self._pending[key]
+        asyncio.create_task(self._send(key, bucket))
+
+    async def _send(self, key: tuple, bucket: list):
+        model, max_new_tokens, temperature, top_p, deterministic = key
+        GATEWAY_BATCH_SIZE.observe(len(bucket))
+        if len(bucket) > 1:
+            COALESCED.labels(kind="batched").inc(len(bucket))
+        headers = bucket[0][1] if len(bucket) == 1 else {"x-batch-size": str(len(bucket))}
+        payload = {
+            "prompt": [prompt for prompt, _, _ in bucket],
+            "model": model,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "deterministic": deterministic,
+        }
+        try:
+            data = await call_upstream(payload, headers)
+            texts = data.get("generated_texts") or []
+            if len(texts) != len(bucket):
+                raise HTTPException(status_code=502, detail="Upstream returned a mismatched batch")
+        except Exception as e:
+            for _, _, fut in bucket:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        usage = data.get("usage", {}) or {}
+        for i, (_, _, fut) in enumerate(bucket):
+            if not fut.done():
+                fut.set_result({
+                    "generated_text": texts[i],
+                    "generated_texts": [texts[i]],
+                    "usage": split_usage(usage, i, len(bucket)),
+                })
+
+coalescer = UpstreamCoalescer(GATEWAY_BATCH_WINDOW_MS, GATEWAY_BATCH_MAX)
+
+def record_usage(key: ResolvedKey, usage_info: dict, start: float, cache_hit: bool = False):
+    labels_id = str(key.key_id)
+    usage_info = usage_info or {}
+    # Update Prometheus counters
+    PROMPT_TOKENS.labels(api_key=labels_id).inc(usage_info.get("prompt_tokens") or 0)
+    COMPLETION_TOKENS.labels(api_key=labels_id).inc(usage_info.get("completion_tokens") or 0)
+    TOTAL_TOKENS.labels(api_key=labels_id).inc(usage_info.get("total_tokens") or 0)
+
+    # Queue usage for the background ledger writer
+    usage_writer.submit({
+        "api_key_id": key.key_id,
+        "prompt_tokens": usage_info.get("prompt_tokens"),
+        "completion_tokens": usage_info.get("completion_tokens"),
+        "total_tokens": usage_info.get("total_tokens"),
+        "used_at": datetime.utcnow(),
+        "latency_ms": int((time.time() - start) * 1000),
+        "cache_hit": cache_hit,
+    })
+
+async def open_upstream_stream(payload: dict, headers: dict) -> httpx.Response:
+    """Start a streaming upstream POST; raises HTTPException before any bytes reach the client."""
+    replica = replica_pool.pick()
+    request_id, headers = upstream_headers(headers)
+    req = upstream_client.build_request("POST", replica.url, json=payload, headers=headers)
+    replica_pool.acquire(replica)
+    t0 = time.time()
+    try:
+        resp = await upstream_client.send(req, stream=True)
+    except httpx.RequestError as e:
+        replica_pool.release(replica, time.time() - t0, ok=False)
+        raise HTTPException(status_code=502, detail=f"Model server not reachable: {e}") from e
+    # the replica stays acquired until UpstreamRelay has relayed the whole body
+    resp.extensions["fs_replica"] = (replica, t0, request_id)
+    if resp.status_code >= 400:
+        replica_pool.release(replica, time.time() - t0, ok=upstream_ok(resp))
+        await resp.aread()
+        await resp.aclose()
+        raise upstream_error(resp)
+    return resp
+
+class GuardedStreamingResponse(StreamingResponse):
+    """StreamingResponse that always runs `cleanup`, even when the client leaves before the body starts."""
+
+    def __init__(self, content, cleanup, **kwargs):
+        super().__init__(content, **kwargs)
+        self.cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.cleanup()
+
+class UpstreamRelay:
+    """Relays one upstream SSE stream and releases its slot, replica and connection exactly once."""
+
+    def __init__(self, resp: httpx.Response, key: ResolvedKey, start: float, on_done=None):
+        self.resp = resp
+        self.key = key
+        self.start = start
+        self.on_done = on_done
+        self.usage_info = {}
+        self.relayed_tokens = 0
+        self.upstream_failed = False
+        self.finished = False
+        self.closed = False
+
+    async def events(self):
+        """Relay upstream SSE events to the client."""
+        first_token = True
+        try:
+            with UPSTREAM_INFLIGHT.track_inprogress():
+                async for line in self.resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    try:
+                        event = json.loads(line[5:].strip())
+                    except ValueError:
+                        continue
+                    if event.get("text"):
+                        if first_token:
+                            GEN_TTFT.observe(time.time() - self.start)
+                            first_token = False
+                        self.relayed_tokens += 1
+                    if event.get("error"):
+                        # the model server failed mid-generation and said so in an error event
+                        self.upstream_failed = True
+                        yield f"data: {json.dumps(event)}\n\n"
+                        return
+                    if event.get("done"):
+                        self.usage_info = event.get("usage", {}) or {}
+                        observe_upstream_usage(self.usage_info)
+                        self.finished = True
+                    yield f"data: {json.dumps(event)}\n\n"
+        except httpx.RequestError as e:
+            self.upstream_failed = True
+            yield f"data: {json.dumps({'error': f'Model server stream interrupted: {e}'})}\n\n"
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Release everything the stream holds and record usage; safe to call more than once."""
+        if self.closed:
+            return
+        self.closed = True
+        replica, t0, request_id = self.resp.extensions["fs_replica"]
+        try:
+            if not self.finished and not self.upstream_failed:
+                # the client disconnected mid-stream, or before the body started
+                CANCELLED.labels(reason="client_disconnect").inc()
+                cancel_upstream(replica, request_id)
+            await self.resp.aclose()
+        finally:
+            replica_pool.release(replica, time.time() - t0, ok=not self.upstream_failed)
+            if self.on_done is not None:
+                self.on_done()
+            LAT.observe(time.time() - self.start)
+        if self.finished:
+            record_usage(self.key, self.usage_info, self.start)
+            HTTP_REQS.labels(route="/generate", code="200").inc()
+            GEN_LAT.observe(time.time() - self.start)
+            return
+        if self.upstream_failed:
+            HTTP_REQS.labels(route="/generate", code="502").inc()
+        if self.relayed_tokens:
+            # no final usage event: bill what the client was actually sent
+            record_usage(self.key, {"completion_tokens": self.relayed_tokens, "total_tokens": self.relayed_tokens}, self.start)
+
+    def response(self) -> StreamingResponse:
+        events = self.events()
+
+        async def cleanup():
+            await events.aclose()  # runs the relay's own finally if it was left suspended
+            await self.close()  # covers a body that never started
+
+        return GuardedStreamingResponse(
+            events,
+            cleanup,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+#offline batch jobs
+class JobRunner:
+    """Worker pool that drains batch jobs in large upstream batches at low scheduling priority."""
+
+    def __init__(self, workers: int, batch_size: int, max_attempts: int, poll_interval: float):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._tasks: list[asyncio.Task] = []
+        self._wake: asyncio.Event | None = None
+        self._claim_lock: asyncio.Lock | None = None
+
+    async def start(self):
+        if self.workers <= 0:
+            return
+        self._wake = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        # chunks that were mid-flight when the gateway stopped are picked up again, unless their job was cancelled
+        cancelled_jobs = sa.select(BatchJob.id).where(BatchJob.status == "cancelled")
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                sa.update(BatchJobItem)
+                .where(BatchJobItem.status == "running", BatchJobItem.job_id.in_(cancelled_jobs))
+                .values(status="cancelled")
+            )
+            await conn.execute(
+                sa.update(BatchJobItem).where(BatchJobItem.status == "running").values(status="pending")
+            )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _worker(self):
+        while True:
+            try:
+                claimed = await self._claim()
+            except Exception as e:
+                print("Job claim failed:", e)
+                claimed = None
+            if claimed is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(*claimed)
+            except Exception as e:
+                print("Job batch failed:", e)
+
+    async def _claim(self):
+        """Mark the next chunk of pending prompts (oldest job first) as running."""
+        async with self._claim_lock, AsyncSessionLocal() as db:
+            job_id = (await db.execute(
+                sa.select(BatchJob.id)
+                .join(BatchJobItem, BatchJobItem.job_id == BatchJob.id)
+                .where(BatchJob.status.in_(("queued", "running")), BatchJobItem.status == "pending")
+                .order_by(BatchJob.created_at, BatchJobItem.idx)
+                .limit(1)
+            )).scalar()
+            if job_id is None:
+                return None
+            items = (await db.execute(
+                sa.select(BatchJobItem.id, BatchJobItem.prompt, BatchJobItem.attempts)
+                .where(BatchJobItem.job_id == job_id, BatchJobItem.status == "pending")
+                .order_by(BatchJobItem.idx)
+                .limit(self.batch_size)
+            )).all()
+            row = (await db.execute(
+                sa.select(
+                    BatchJob.params, APIKey.id, APIKey.project_id, APIKey.revoked,
+                    Project.company_id, Project.priority_class, Project.sched_weight,
+                )
+                .join(APIKey, BatchJob.api_key_id == APIKey.id)
+                .join(Project, APIKey.project_id == Project.id)
+                .where(BatchJob.id == job_id)
+            )).first()
+            await db.execute(
+                sa.update(BatchJobItem).where(BatchJobItem.id.in_([i.id for i in items])).values(status="running")
+            )
+            await db.execute(
+                sa.update(BatchJob).where(BatchJob.id == job_id, BatchJob.status == "queued").values(status="running")
+            )
+            await db.commit()
+        key = ResolvedKey(
+            key_id=row.id,
+            project_id=row.project_id,
+            company_id=row.company_id,
+            revoked=bool(row.revoked),
+            priority_class=row.priority_class or "interactive",
+            sched_weight=project_weight(row.priority_class, row.sched_weight),
+        )
+        return job_id, row.params or {}, key, items
+
+    async def _process(self, job_id: str, params: dict, key: ResolvedKey, items: list):
+        if key.revoked:
+            await self._fail(job_id, items, "API key revoked", transient=False)
+            return
+        try:
+            # job batches are a flow of their own at a low weight, so the project's interactive
+            # requests never queue behind its job; rejections here are not /generate responses
+            await admission.acquire(
+                key._replace(priority_class="batch_job", sched_weight=JOBS_SCHED_WEIGHT),
+                cost=len(items),
+                flow=("job", key.project_id),
+                route=None,
+            )
+        except HTTPException:
+            await self._requeue(job_id, items, count_attempt=False)
+            await asyncio.sleep(admission.retry_after)
+            return
+        start = time.time()
+        JOB_BATCH_SIZE.observe(len(items))
+        payload = {**params, "prompt": [i.prompt for i in items]}
+        headers = {
+            "x-company-id": str(key.company_id),
+            "x-project-id": str(key.project_id),
+            "x-api-key-id": str(key.key_id),
+            "x-batch-job": job_id,
+        }
+        try:
+            try:
+                # batch jobs are throughput work: duplicating whole chunks would spend the interactive hedge budget
+                data = await call_upstream(payload, headers, hedge=False)
+            finally:
+                admission.release()
+            texts = data.get("generated_texts") or []
+            if len(texts) != len(items):
+                raise HTTPException(status_code=502, detail="Upstream returned a mismatched batch")
+        except Exception as e:
+            transient = not isinstance(e, HTTPException) or e.status_code in (429, 502, 503, 504)
+            await self._fail(job_id, items, str(getattr(e, "detail", e)), transient)
+            if transient:
+                await asyncio.sleep(self.poll_interval)  # back off before the chunk is claimed again
+            return
+        usage = data.get("usage", {}) or {}
+        results = [(item, texts[n], split_usage(usage, n, len(items))) for n, item in enumerate(items)]
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                sa.update(BatchJobItem)
+                .where(BatchJobItem.id == sa.bindparam("item_id"))
+                .values(status="done", output=sa.bindparam("text"), usage=sa.bindparam("item_usage")),
+                [{"item_id": item.id, "text": text, "item_usage": u} for item, text, u in results],
+            )
+            await conn.execute(
+                sa.update(BatchJob).where(BatchJob.id == job_id).values(completed=BatchJob.completed + len(results))
+            )
+            await self._maybe_finish(conn, job_id)
+        JOB_ITEMS.labels(outcome="done").inc(len(results))
+        # each prompt is billed to the key that submitted the job
+        for _, _, u in results:
+            record_usage(key, u, start)
+
+    async def _requeue(self, job_id: str, items: list, count_attempt: bool):
+        async with async_engine.begin() as conn:
+            job_status = (await conn.execute(sa.select(BatchJob.status).where(BatchJob.id == job_id))).scalar()
+            await conn.execute(
+                sa.update(BatchJobItem)
+                .where(BatchJobItem.id.in_([i.id for i in items]), BatchJobItem.status == "running")
+                .values(
+                    # _claim skips cancelled jobs, so a pending item there would never be picked up again
+                    status="cancelled" if job_status == "cancelled" else "pending",
+                    attempts=BatchJobItem.attempts + 1 if count_attempt else BatchJobItem.attempts,
+                )
+            )
+
+    async def _fail(self, job_id: str, items: list, error: str, transient: bool):
+        retry = [i for i in items if transient and i.attempts + 1 < self.max_attempts]
+        dead = [i for i in items if i not in retry]
+        if retry:
+            await self._requeue(job_id, retry, count_attempt=True)
+            JOB_ITEMS.labels(outcome="retried").inc(len(retry))
+        if not dead:
+            return
+        async with async_engine.begin() as conn:
+            await conn.execute(
+                sa.update(BatchJobItem)
+                .where(BatchJobItem.id.in_([i.id for i in dead]), BatchJobItem.status == "running")
+                .values(status="failed", error=error[:500], attempts=BatchJobItem.attempts + 1)
+            )
+            await conn.execute(
+                sa.update(BatchJob).where(BatchJob.id == job_id).values(failed=BatchJob.failed + len(dead))
+            )
+            await self._maybe_finish(conn, job_id)
+        JOB_ITEMS.labels(outcome="failed").inc(len(dead))
+
+    @staticmethod
+    async def _maybe_finish(conn, job_id: str):
+        left = (await conn.execute(
+            sa.select(sa.func.count(BatchJobItem.id))
+            .where(BatchJobItem.job_id == job_id, BatchJobItem.status.in_(("pending", "running")))
+        )).scalar()
+        if not left:
+            await conn.execute(
+                sa.update(BatchJob)
+                .where(BatchJob.id == job_id, BatchJob.status != "cancelled")
+                .values(status="completed", finished_at=datetime.utcnow())
+            )
+
+job_runner = JobRunner(JOBS_WORKERS, JOBS_BATCH_SIZE, JOBS_MAX_ATTEMPTS, JOBS_POLL_INTERVAL)
+
+@app.on_event("startup")
+async def start_job_runner():
+    await job_runner.start()
+
+def parse_job_lines(body: bytes) -> list[dict]:
+    """NDJSON upload: one {"prompt": ..., "custom_id": ...} object (or bare string) per line."""
+    items = []
+    for n, line in enumerate(body.decode("utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"line {n}: invalid JSON")
+        if isinstance(obj, str):
+            obj = {"prompt": obj}
+        if not isinstance(obj, dict) or not isinstance(obj.get("prompt"), str) or not obj["prompt"]:
+            raise HTTPException(status_code=400, detail=f"line {n}: expected an object with a non-empty prompt")
+        custom_id = obj.get("custom_id")
+        items.append({"prompt": obj["prompt"], "custom_id": None if custom_id is None else str(custom_id)})
+    return items
+
+def job_status(job: BatchJob) -> dict:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "total": job.total,
+        "completed": job.completed,
+        "failed": job.failed,
+        "pending": job.total - job.completed - job.failed if job.status != "cancelled" else 0,
+        "params": job.params,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+async def require_job_key(x_api_key: str | None) -> ResolvedKey:
+    if not x_api_key:
+        raise HTTPException(status_code=400, detail="API key missing")
+    key = await resolve_api_key(x_api_key)
+    if not key or key.revoked:
+        raise HTTPException(status_code=403, detail="Invalid or revoked API key")
+    return key
+
+async def get_job(db: AsyncSession, job_id: str, key: ResolvedKey) -> BatchJob:
+    job = await db.get(BatchJob, job_id)
+    # jobs are visible to every key of the submitting project
+    if not job or job.project_id != key.project_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    params: JobParams = Depends(),
+    x_api_key: str = Header(None),
+):
+    key = await require_job_key(x_api_key)
+    if params.temperature <= 0 or params.temperature > 2.0:
+        raise HTTPException(status_code=400, detail="temperature must be > 0 and <= 2.0")
+    # read the (possibly slow) upload before taking a DB connection
+    items = parse_job_lines(await request.body())
+    if not items:
+        raise HTTPException(status_code=400, detail="no prompts in upload")
+    if len(items) > JOBS_MAX_PROMPTS:
+        raise HTTPException(status_code=413, detail=f"at most {JOBS_MAX_PROMPTS} prompts per job")
+    job = BatchJob(
+        id=uuid.uuid4().hex,
+        api_key_id=key.key_id,
+        project_id=key.project_id,
+        status="queued",
+        params=params.dict(),
+        total=len(items),
+        completed=0,
+        failed=0,
+    )
+    async with AsyncSessionLocal() as db:
+        db.add(job)
+        await db.flush()
+        await db.execute(
+            sa.insert(BatchJobItem),
+            [{"job_id": job.id, "idx": n, "status": "pending", "attempts": 0, **item} for n, item in enumerate(items)],
+        )
+        await db.commit()
+    job_runner.wake()
+    return {"job_id": job.id, "status": job.status, "total": job.total}
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, x_api_key: str = Header(None)):
+    key = await require_job_key(x_api_key)
+    async with AsyncSessionLocal() as db:
+        return job_status(await get_job(db, job_id, key))
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str, x_api_key: str = Header(None)):
+    key = await require_job_key(x_api_key)
+    async with AsyncSessionLocal() as db:
+        job = await get_job(db, job_id, key)
+        if job.status in ("queued", "running"):
+            # chunks already sent upstream still complete; everything else is dropped
+            await db.execute(
+                sa.update(BatchJobItem)
+                .where(BatchJobItem.job_id == job_id, BatchJobItem.status == "pending")
+                .values(status="cancelled")
+            )
+            job.status = "cancelled"
+            job.finished_at = datetime.utcnow()
+            await db.commit()
+        return job_status(job)
+
+@app.get("/jobs/{job_id}/results")
+async def job_results(
+    job_id: str,
+    follow: bool = False,
+    x_api_key: str = Header(None),
+):
+    """Stream finished results as NDJSON in upload order; follow=true keeps streaming until the job is done."""
+    key = await require_job_key(x_api_key)
+    async with AsyncSessionLocal() as db:
+        job = await get_job(db, job_id, key)
+    return StreamingResponse(stream_job_results(job_id, job.total, follow), media_type="application/x-ndjson")
+
+async def stream_job_results(job_id: str, total: int, follow: bool, page_size: int = 500):
+    next_idx = 0
+    while next_idx < total:
+        # short sessions so a long follow never pins a read transaction
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                sa.select(
+                    BatchJobItem.idx, BatchJobItem.custom_id, BatchJobItem.status,
+                    BatchJobItem.output, BatchJobItem.usage, BatchJobItem.error,
+                )
+                .where(BatchJobItem.job_id == job_id, BatchJobItem.idx >= next_idx)
+                .order_by(BatchJobItem.idx)
+                .limit(page_size)
+            )).all()
+        start_idx = next_idx
+        for r in rows:
+            if r.status in ("pending", "running"):
+                break
+            out = {"index": r.idx, "custom_id": r.custom_id, "status": r.status}
+            if r.status == "done":
+                out.update(generated_text=r.output, usage=r.usage)
+            else:
+                out["error"] = r.error or r.status
+            yield json.dumps(out, default=str) + "\n"
+            next_idx = r.idx + 1
+        if next_idx > start_idx:
+            continue
+        if not follow:
+            return
+        async with AsyncSessionLocal() as db:
+            status = (await db.execute(sa.select(BatchJob.status).where(BatchJob.id == job_id))).scalar()
+            running = (await db.execute(
+                sa.select(sa.func.count(BatchJobItem.id))
+                .where(BatchJobItem.job_id == job_id, BatchJobItem.idx >= next_idx, BatchJobItem.status == "running")
+            )).scalar()
+        # once the job is over nothing moves except chunks still upstream; wait for those, then stop
+        if status in ("completed", "cancelled") and not running:
+            return
+        await asyncio.sleep(JOBS_POLL_INTERVAL)
+
 #health check
 @app.get("/health")
 def health():
@@ -608,29 +2383,33 @@ def system_health(ctx=Depends(get_auth_context), db: Session = Depends(get_db)):
     mem_pct = vm.percent
     mem_free_gb = round(vm.available / (1024**3), 2)
 
-    # Model server ping (prefer /health, fallback to tiny /generate)
+    # Model server ping: /ready, falling back to a tiny /generate only for servers without /ready
     model_ok = False
     model_latency_ms = None
+    replica = replica_pool.pick()
+    t0 = time.time()
     try:
-        with httpx.Client(timeout=5.0) as client:
-            t0 = time.time()
-            # try /health if available
-            health_url = MODEL_SERVER_URL.replace("/generate", "/health")
-            r = client.get(health_url)
-            if r.status_code == 200:
-                model_ok = True
-                model_latency_ms = int((time.time() - t0) * 1000)
-            else:
-                raise RuntimeError("health not 200")
+        ready_status = upstream_sync_client.get(replica.ready_url, timeout=5.0).status_code
     except Exception:
+        ready_status = None
+    if ready_status == 200:
+        model_ok = True
+        model_status = "ready"
+        model_latency_ms = int((time.time() - t0) * 1000)
+    elif ready_status == 503:
+        # still loading/warming up: report it, don't push a generation at the cold server
+        model_status = "loading"
+    elif ready_status in (None, 404):
         try:
-            with httpx.Client(timeout=10.0) as client:
-                t0 = time.time()
-                r = client.post(MODEL_SERVER_URL, json={"prompt": ["ping"], "max_new_tokens": 1})
-                model_ok = r.status_code == 200
-                model_latency_ms = int((time.time() - t0) * 1000)
+            t0 = time.time()
+            r = upstream_sync_client.post(replica.url, json={"prompt": ["ping"], "max_new_tokens": 1}, timeout=10.0)
+            model_ok = r.status_code == 200
+            model_latency_ms = int((time.time() - t0) * 1000)
         except Exception:
             model_ok = False
+        model_status = "ready" if model_ok else "down"
+    else:
+        model_status = "error"
 
     return {
         "ok": db_ok and model_ok,
@@ -641,9 +2420,11 @@ def system_health(ctx=Depends(get_auth_context), db: Session = Depends(get_db)):
             "free_memory_gb": mem_free_gb,
         },
         "model_server": {
-            "url": MODEL_SERVER_URL,
+            "url": replica.url,
             "ok": model_ok,
+            "status": model_status,
             "latency_ms": model_latency_ms,
+            "replicas": replica_pool.snapshot(),
         },
         "db": {"ok": db_ok},
         "gpu": None,  # CPU-only
@@ -653,6 +2434,53 @@ def system_health(ctx=Depends(get_auth_context), db: Session = Depends(get_db)):
 def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+# model downloads run on a model-server replica, which writes into the MODEL_BASE_DIR volume all replicas share;
+# each replica only knows the downloads it runs, so status calls ask every replica
+def _model_server_call(replica: Replica, method: str, path: str, **kwargs):
+    try:
+        r = upstream_sync_client.request(method, replica.api_url(path), timeout=30.0, **kwargs)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"model server unreachable: {e}")
+    if r.status_code >= 400:
+        try:
+            detail = r.json().get("detail")
+        except ValueError:
+            detail = r.text
+        raise HTTPException(status_code=r.status_code, detail=detail)
+    return r.json()
+
+def _find_download(job_id: str) -> tuple[Replica, dict]:
+    for replica in replica_pool.replicas:
+        try:
+            return replica, _model_server_call(replica, "GET", f"/models/downloads/{quote(job_id, safe='')}")
+        except HTTPException:
+            continue
+    raise HTTPException(status_code=404, detail="unknown download")
+
+@app.post("/admin/models/download", status_code=202)
+def start_model_download(request: DownloadRequest, _=Depends(require_operator)):
+    """Fetch a model's weights into the model servers' MODEL_BASE_DIR; call again to resume an interrupted download."""
+    return _model_server_call(replica_pool.pick(), "POST", "/models/download", json=request.dict())
+
+@app.get("/admin/models/downloads")
+def list_model_downloads(_=Depends(require_operator)):
+    out = []
+    for replica in replica_pool.replicas:
+        try:
+            out.extend(_model_server_call(replica, "GET", "/models/downloads")["downloads"])
+        except HTTPException:
+            continue
+    return {"downloads": out}
+
+@app.get("/admin/models/downloads/{job_id}")
+def model_download_status(job_id: str, _=Depends(require_operator)):
+    return _find_download(job_id)[1]
+
+@app.post("/admin/models/downloads/{job_id}/cancel")
+def cancel_model_download(job_id: str, _=Depends(require_operator)):
+    replica, _ = _find_download(job_id)
+    return _model_server_call(replica, "POST", f"/models/downloads/{quote(job_id, safe='')}/cancel")
+
 @app.get("/admin/stats/summary")
 def stats_summary(ctx=Depends(get_auth_context), db: Session = Depends(get_db)):
     company_id = ctx["company_id"]
@@ -1,8 +1,16 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from transformers import AutoModelForCausalLM, AutoTokenizer
-import torch, os
-from prometheus_client import Summary, generate_latest, CONTENT_TYPE_LATEST
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, DynamicCache, StoppingCriteria, StoppingCriteriaList, LogitsProcessor, LogitsProcessorList
+import torch, os, gc, json, math, time, queue, uuid, fcntl, shutil, hashlib, inspect, httpx, anyio
+from threading import Condition, Event, Lock, Semaphore, Thread, local
+from typing import NamedTuple
+from collections import OrderedDict
+from glob import glob
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from urllib.parse import quote
+from huggingface_hub import snapshot_download
+from prometheus_client import Counter, Gauge, Histogram, Summary, generate_latest, CONTENT_TYPE_LATEST
 from fastapi import Response
 
 app = FastAPI(title="Model Server")
@@ -12,77 +20,2264 @@ device = torch.device("cpu")
 if os.cpu_count():
     torch.set_num_threads(os.cpu_count())
 
-MODEL_REPO = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+# Model registry: models live in MODEL_BASE_DIR/<org>/<name>, load on the first request that names them
+# and are evicted least recently used once their weights no longer fit MODEL_MEMORY_BUDGET
+MODEL_BASE_DIR = os.getenv("MODEL_BASE_DIR", "models")
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "TinyLlama/TinyLlama-1.1B-Chat-v1.0")  # fetched from the Hub if not on disk
+MODEL_MEMORY_BUDGET = int(os.getenv("MODEL_MEMORY_BUDGET", str(16 * 1024 ** 3)))  # bytes of resident weights; 0 = unlimited
+MODEL_RETRY_AFTER = int(os.getenv("MODEL_RETRY_AFTER", "5"))  # Retry-After when the budget is held by busy models
+MODEL_SWAP_HISTORY = int(os.getenv("MODEL_SWAP_HISTORY", "20"))  # finished hot swaps kept for /info
+DEFAULT_MODEL_RETRY_MAX = float(os.getenv("DEFAULT_MODEL_RETRY_MAX", "60"))  # cap in seconds on the backoff between startup load attempts
 
-# Load TinyLlama at startup
-tokenizer = AutoTokenizer.from_pretrained(MODEL_REPO, padding_side="left")
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_REPO,
-    dtype=torch.float32
-).to(device)
-model.eval()
+# Dynamic batching: concurrent requests with identical sampling params share one forward pass
+BATCH_ENABLED = os.getenv("BATCH_ENABLED", "1") == "1"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))  # prompts per model.generate call
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# Length bucketing: multi-prompt batches are split so no prompt is padded past RATIO x the shortest in its sub-batch
+LENGTH_BUCKETING = os.getenv("LENGTH_BUCKETING", "1") == "1"
+LENGTH_BUCKET_RATIO = float(os.getenv("LENGTH_BUCKET_RATIO", "1.5"))
+# each extra sub-batch costs a full decode loop, so only split when it saves at least this many pad tokens per row
+LENGTH_BUCKET_MIN_GAP = int(os.getenv("LENGTH_BUCKET_MIN_GAP", "64"))
+
+# "static" = batch scheduler around model.generate, "continuous" = iteration-level engine
+ENGINE_MODE = os.getenv("ENGINE_MODE", "static")
+ENGINE_MAX_ACTIVE = int(os.getenv("ENGINE_MAX_ACTIVE", "16"))  # sequences decoded together
+
+# Prefix KV cache for shared system prompts
+PREFIX_CACHE_MAX_BYTES = int(os.getenv("PREFIX_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))  # 0 disables
+PREFIX_BLOCK_TOKENS = int(os.getenv("PREFIX_BLOCK_TOKENS", "16"))  # prefixes are cached at these boundaries
+PREFIX_MIN_SEEN = int(os.getenv("PREFIX_MIN_SEEN", "2"))  # cache a prefix once it has been seen this often
+
+# Admission control: beyond MAX_CONCURRENT running and MAX_QUEUE waiting, /generate is shed immediately
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))  # 0 disables admission control
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))  # seconds a queued request may wait
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))  # Retry-After hint on rejections
+
+# Speculative decoding: a small draft model of the same family proposes tokens and the target verifies them in one pass
+SPECULATIVE_DRAFT = os.getenv("SPECULATIVE_DRAFT", "")  # draft for DEFAULT_MODEL (repo id or path); "auto" = every model's catalog draft_repo_id; "" disables
+CURATED_MODELS_PATH = os.getenv("CURATED_MODELS_PATH", "curated_models.json")  # catalog read by SPECULATIVE_DRAFT=auto
+
+# Warmup: a model runs these shapes once before it takes traffic, so kernels (and torch.compile graphs)
+# are built and its memory-mapped weights are paged in before the first real request
+WARMUP_LENGTHS = [int(x) for x in os.getenv("WARMUP_LENGTHS", "16,128,512").split(",") if x.strip()]  # prompt tokens; empty disables
+WARMUP_BATCH_SIZES = [int(x) for x in os.getenv("WARMUP_BATCH_SIZES", "1").split(",") if x.strip()]
+WARMUP_NEW_TOKENS = int(os.getenv("WARMUP_NEW_TOKENS", "8"))
+
+# Downloads: fetch a repo's config, tokenizer and weights into MODEL_BASE_DIR/<org>/<name> in parallel
+# ranged chunks, resumable across interruptions, checksum-verified, then moved into place in one rename
+HF_ENDPOINT = os.getenv("HF_ENDPOINT", "https://huggingface.co").rstrip("/")  # any server with the Hub's /api + /resolve layout
+HF_TOKEN = os.getenv("HF_TOKEN")  # for gated or private repos
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))  # concurrent ranged requests per download
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("DOWNLOAD_CHUNK_BYTES", str(64 * 1024 * 1024)))  # also the unit of resume
+DOWNLOAD_MAX_BYTES_PER_SECOND = int(os.getenv("DOWNLOAD_MAX_BYTES_PER_SECOND", "0"))  # per download; 0 = unlimited
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))  # attempts per chunk
+
+# Inference backend: "fp32" eager; "bf16" (fp32 if the CPU lacks bf16 support); "int8" dynamically
+# quantized Linear layers; "compile" torch.compile + static KV cache (needs a C++ toolchain, else fp32)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "fp32")
+BACKENDS = ("fp32", "bf16", "int8", "compile")
+
+def _bf16_supported() -> bool:
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+# from_pretrained swaps torch's process-wide default dtype while it builds a model, so loads must not overlap
+_load_lock = Lock()
+
+def _load_model(repo: str, backend: str, revision: str | None = None):
+    """Load repo prepared for backend; returns the model and the backend actually in effect.
+
+    Safetensors weights are memory-mapped: when the checkpoint is already stored in the compute
+    dtype, parameters point straight into the page cache, so peak RSS stays near zero until the
+    weights are touched and a restart re-reads nothing that is still cached. Any dtype conversion
+    (a bf16 checkpoint served as fp32, say) has to materialize a converted copy instead.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if backend == "bf16" and not _bf16_supported():
+        backend = "fp32"
+    with _load_lock:
+        m = AutoModelForCausalLM.from_pretrained(
+            repo,
+            dtype=torch.bfloat16 if backend == "bf16" else torch.float32,
+            use_safetensors=True if glob(os.path.join(repo, "*.safetensors")) else None,
+            revision=revision,
+        )
+    if device.type != "cpu":
+        m = m.to(device)  # on CPU this would be a no-op at best and a copy out of the mmap at worst
+    m.eval()
+    if backend == "int8":
+        # in place: the default deep-copies the model first, pulling every mmapped weight into RAM
+        m = torch.ao.quantization.quantize_dynamic(m, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif backend == "compile":
+        m.generation_config.cache_implementation = "static"
+        m.forward = torch.compile(m.forward)
+        try:
+            # compilation is lazy; trigger it now so a missing toolchain shows up at load, not on a request
+            with torch.inference_mode():
+                m.generate(input_ids=torch.tensor([[m.config.bos_token_id or 0]], device=device), max_new_tokens=2, do_sample=False)
+        except Exception:
+            del m.forward
+            m.generation_config.cache_implementation = None
+            backend = "fp32"
+    return m, backend
+
+def _model_bytes(m) -> int:
+    """Weight bytes, counting the packed int8 weights that quantized layers keep outside parameters()."""
+    total = 0
+    for value in m.state_dict().values():
+        for t in value if isinstance(value, tuple) else (value,):
+            if isinstance(t, torch.Tensor):
+                total += t.numel() * t.element_size()
+    return total
+
+def _proc_status_bytes(field: str) -> int | None:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss() -> bool:
+    """Restart VmHWM from the current RSS (Linux), so a load's own peak can be read afterwards."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _local_model_dir(name: str) -> str | None:
+    path = name if os.path.isabs(name) else os.path.join(MODEL_BASE_DIR, name)
+    return path if os.path.isfile(os.path.join(path, "config.json")) else None
+
+def _check_model_name(name: str):
+    parts = name.split("/")
+    # dot-prefixed parts also keep requests out of MODEL_BASE_DIR/.downloads staging and the Hub cache
+    if not name or os.path.isabs(name) or any(not part or part.startswith(".") for part in parts):
+        raise HTTPException(status_code=400, detail=f"invalid model name {name!r}")
+
+def _model_source(name: str) -> str:
+    """Where to load a requested model from: its MODEL_BASE_DIR directory, or the Hub for DEFAULT_MODEL."""
+    _check_model_name(name)
+    local = _local_model_dir(name)
+    if local is not None:
+        return local
+    if name == DEFAULT_MODEL:
+        return name
+    raise HTTPException(status_code=404, detail=f"model {name} is not available")
+
+def _safetensors_tensors(source: str) -> list[dict]:
+    """dtype/shape entries from the headers of every safetensors shard; reads a few KB, not the weights."""
+    tensors = []
+    for path in glob(os.path.join(source, "*.safetensors")):
+        with open(path, "rb") as f:
+            header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+        tensors.extend(t for k, t in header.items() if k != "__metadata__")
+    return tensors
+
+def _stored_dtype(source: str) -> str | None:
+    dtypes = {t["dtype"] for t in _safetensors_tensors(source)}
+    return dtypes.pop() if len(dtypes) == 1 else None
+
+def _config_params(source: str, revision: str | None = None) -> int:
+    """Parameter count from the config alone, by building the model on the meta device; 0 if unknown."""
+    try:
+        config = AutoConfig.from_pretrained(source, revision=revision)
+        with torch.device("meta"):
+            model = AutoModelForCausalLM.from_config(config)
+    except Exception:
+        return 0  # e.g. the Hub is unreachable: the check after loading still enforces the budget
+    return sum(p.numel() for p in model.parameters())
+
+def _estimate_bytes(source: str, backend: str = INFERENCE_BACKEND, revision: str | None = None) -> int:
+    """Weights the model will take once loaded; read from safetensors headers, so nothing is loaded yet."""
+    path = source
+    if not os.path.isdir(source):
+        # a Hub repo id: use the cached snapshot if there is one, otherwise its config
+        try:
+            path = snapshot_download(source, revision=revision, local_files_only=True)
+        except Exception:
+            path = None
+    params = sum(math.prod(t["shape"]) for t in _safetensors_tensors(path)) if path else 0
+    if not params and not os.path.isdir(source):
+        params = _config_params(source, revision)
+    if params:
+        # int8 quantizes after an fp32 load, so fp32 is also its peak
+        return params * (2 if backend == "bf16" else 4)
+    return sum(os.path.getsize(p) for p in glob(os.path.join(source, "*.bin")))
+
+def _estimate_model_bytes(name: str, source: str, revision: str | None = None) -> int:
+    """_estimate_bytes for a registry load: the model plus the draft model that loads beside it."""
+    total = _estimate_bytes(source, revision=revision)
+    draft = _draft_repo(name)
+    if draft:
+        total += _estimate_bytes(_local_model_dir(draft) or draft)
+    return total
+
+def _draft_repo(name: str) -> str | None:
+    if SPECULATIVE_DRAFT != "auto":
+        return (SPECULATIVE_DRAFT or None) if name == DEFAULT_MODEL else None
+    try:
+        with open(CURATED_MODELS_PATH) as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return next((m.get("draft_repo_id") for m in catalog if m.get("repo_id") == name), None)
 
 @app.get("/info")
 def info():
     return {
-        "active_model": MODEL_REPO,
+        "default_model": DEFAULT_MODEL,
         "device": str(device),
         "torch_num_threads": torch.get_num_threads(),
-        "dtype": str(next(model.parameters()).dtype)
+        "requested_backend": INFERENCE_BACKEND,
+        "engine_mode": ENGINE_MODE,
+        "ready": _default_ready.is_set(),
+        "memory_budget_bytes": MODEL_MEMORY_BUDGET,
+        "resident_bytes": registry.resident_bytes(),
+        "reserved_bytes": registry.reserved_bytes(),
+        "models": registry.describe(),
+        "swaps": registry.describe_swaps(),
     }
 
 class GenerationRequest(BaseModel):
     prompt: list[str]
+    model: str | None = None  # registry name, e.g. "Qwen/Qwen2.5-0.5B-Instruct"; None = DEFAULT_MODEL
     max_new_tokens: int = 4092
     temperature: float = 0.8
     top_p: float = 0.95
+    stream: bool = False
+    deterministic: bool = False  # greedy decoding; identical requests give identical output
+    seed: int | None = None  # seeded sampling; seeded requests are never batched with others
+    speculative: bool | None = None  # use the draft model; None follows SPECULATIVE_DRAFT
 
 GEN_TIME = Summary("model_generate_latency_seconds", "Time spent generating")
+BATCH_SIZE = Histogram("model_batch_size", "Prompts per model.generate call", buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_PADDING_RATIO = Histogram(
+    "model_batch_padding_ratio", "Share of prompt positions in a model.generate call that are padding",
+    buckets=(0.0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.0),
+)
+BATCH_QUEUE_WAIT = Histogram(
+    "model_batch_queue_wait_seconds", "Time a request waited for its batch to start",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+)
+PREFIX_LOOKUPS = Counter("model_prefix_cache_lookups_total", "Prefix cache lookups", ["result"])  # hit|miss
+PREFIX_TOKENS_SAVED = Counter("model_prefix_tokens_saved_total", "Prompt tokens not re-encoded thanks to the prefix cache")
+PREFIX_BYTES = Gauge("model_prefix_cache_bytes", "Bytes of KV tensors held by the prefix cache", ["model"])
+ENGINE_QUEUE_DEPTH = Gauge("model_engine_queue_depth", "Sequences waiting to join the continuous batch", ["model"])
+ENGINE_ACTIVE = Gauge("model_engine_active_sequences", "Sequences currently being decoded", ["model"])
+ENGINE_TOKENS = Counter("model_engine_generated_tokens_total", "Tokens produced by the continuous engine")
+ENGINE_TPS = Gauge("model_engine_tokens_per_second", "Continuous engine decode throughput (last second)", ["model"])
+PROMPT_TOKENS = Histogram(
+    "model_prompt_tokens", "Prompt tokens per request",
+    buckets=(8, 32, 128, 256, 512, 1024, 2048, 4096),
+)
+COMPLETION_TOKENS = Histogram(
+    "model_completion_tokens", "Generated tokens per request",
+    buckets=(1, 8, 32, 128, 256, 512, 1024, 2048, 4096),
+)
+PREFILL_TIME = Histogram(
+    "model_prefill_seconds", "Time to encode the prompt and emit the first token, per request",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DECODE_TIME = Histogram(
+    "model_decode_seconds", "Time spent generating after the first token, per request",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+DECODE_TPS = Histogram(
+    "model_decode_tokens_per_second", "Generated tokens per second of decode time, per request",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+CANCELLED = Counter("model_cancelled_requests_total", "Generations stopped early", ["reason"])  # client|deadline
+CANCEL_TOKENS_SAVED = Counter("model_cancelled_tokens_saved_total", "Decode steps skipped (max_new_tokens left) by cancelled generations")
+SPEC_DRAFT_TOKENS = Counter("model_speculative_draft_tokens_total", "Tokens proposed by the draft model")
+SPEC_ACCEPTED_TOKENS = Counter("model_speculative_accepted_tokens_total", "Draft tokens accepted by the target model")
+SPEC_ACCEPTANCE = Histogram(
+    "model_speculative_acceptance_rate", "Share of drafted tokens the target accepted, per request",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+SPEC_TOKENS_PER_STEP = Histogram(
+    "model_speculative_tokens_per_step", "Tokens generated per target forward pass, per request",
+    buckets=(1, 1.25, 1.5, 2, 2.5, 3, 4, 6, 8),
+)
+SPEC_SPEEDUP = Gauge("model_speculative_speedup", "Single-prompt tokens/sec with the draft model over without (moving averages)", ["model"])
+MODEL_LOAD_TIME = Histogram(
+    "model_registry_load_seconds", "Time to load a model (and its draft) into memory", ["model"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+)
+MODEL_RESIDENT = Gauge("model_registry_resident", "1 while the model is loaded", ["model"])
+MODEL_RESIDENT_BYTES = Gauge("model_registry_resident_bytes", "Weight bytes of a loaded model, draft included", ["model"])
+MODEL_INFLIGHT = Gauge("model_registry_inflight", "Generations currently using the model", ["model"])
+MODEL_EVICTIONS = Counter("model_registry_evictions_total", "Models unloaded to fit MODEL_MEMORY_BUDGET", ["model"])
+MODEL_WARMUP_TIME = Histogram(
+    "model_registry_warmup_seconds", "Time spent warming a freshly loaded model before it takes traffic", ["model"],
+    buckets=(0.5, 1, 5, 10, 30, 60, 120, 300),
+)
+MODEL_SWAPS = Counter("model_registry_swaps_total", "Hot swaps of a served model", ["model", "result"])  # ok|failed
+MODEL_SWAP_TIME = Histogram(
+    "model_registry_swap_seconds", "Hot swap phases: loading+warming the replacement, draining the old model", ["model", "phase"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)  # phase: load|warmup|drain|total
+MODEL_DRAINING = Gauge("model_registry_draining", "Generations still running on replaced models", ["model"])
+MODEL_LOAD_PEAK_RSS = Gauge("model_registry_load_peak_rss_bytes", "How far process RSS peaked above its starting point while the model loaded", ["model"])
+MODEL_REQUESTS = Counter("model_requests_total", "Generation requests served, by model", ["model"])
+MODEL_GENERATED_TOKENS = Counter("model_generated_tokens_total", "Tokens generated, by model", ["model"])
+DOWNLOADS = Counter("model_downloads_total", "Finished model downloads", ["result"])  # done|failed|cancelled
+DOWNLOADS_ACTIVE = Gauge("model_downloads_active", "Model downloads in progress")
+DOWNLOAD_BYTES = Counter("model_download_bytes_total", "Bytes fetched by model downloads")
+ADMISSION_INFLIGHT = Gauge("model_admission_inflight", "Generations admitted and running")
+ADMISSION_QUEUE_DEPTH = Gauge("model_admission_queue_depth", "Generations waiting for an admission slot")
+ADMISSION_REJECTIONS = Counter("model_admission_rejections_total", "Generations shed by admission control", ["reason"])  # queue_full|queue_timeout
+
+class AdmissionController:
+    """Caps concurrent generations and the number allowed to wait; everything else is rejected at once."""
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, retry_after: int):
+        self.enabled = max_concurrent > 0
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._slots = Semaphore(max(max_concurrent, 1))
+        self._lock = Lock()
+        self._waiting = 0
+
+    def _reject(self, status_code: int, reason: str, detail: str):
+        ADMISSION_REJECTIONS.labels(reason=reason).inc()
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    def acquire(self):
+        if not self.enabled:
+            return
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self.max_queue:
+                    self._reject(429, "queue_full", "model server is at capacity")
+                self._waiting += 1
+                ADMISSION_QUEUE_DEPTH.set(self._waiting)
+            try:
+                admitted = self._slots.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+                    ADMISSION_QUEUE_DEPTH.set(self._waiting)
+            if not admitted:
+                self._reject(503, "queue_timeout", "timed out waiting for a generation slot")
+        ADMISSION_INFLIGHT.inc()
+
+    def release(self):
+        if not self.enabled:
+            return
+        ADMISSION_INFLIGHT.dec()
+        self._slots.release()
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER)
+
+class CancelToken:
+    """Per-request stop flag, set by POST /cancel/{id} or by the deadline passing; decoders poll it every step."""
+
+    def __init__(self, request_id: str | None, timeout: float | None):
+        self.request_id = request_id
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: str | None = None
+        self.triggered = False  # some decoding was actually cut short
+
+    def cancel(self, reason: str = "client"):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "deadline"
+        return self.reason is not None
+
+    def stopped(self, tokens_saved: int):
+        """Record one prompt of this request being cut short."""
+        if not self.triggered:
+            self.triggered = True
+            CANCELLED.labels(reason=self.reason).inc()
+        CANCEL_TOKENS_SAVED.inc(max(tokens_saved, 0))
+
+class CancelRegistry:
+    def __init__(self):
+        self._tokens: dict[str, CancelToken] = {}
+        self._lock = Lock()
+
+    def register(self, token: CancelToken):
+        if token.request_id:
+            with self._lock:
+                self._tokens[token.request_id] = token
+
+    def unregister(self, token: CancelToken):
+        if token.request_id:
+            with self._lock:
+                if self._tokens.get(token.request_id) is token:
+                    del self._tokens[token.request_id]
+
+    def cancel(self, request_id: str) -> bool:
+        with self._lock:
+            token = self._tokens.get(request_id)
+        if token is None:
+            return False
+        token.cancel("client")
+        return True
+
+cancellations = CancelRegistry()
+
+class _CancelCriteria(StoppingCriteria):
+    """Stops each row of a model.generate batch once its request's token is cancelled."""
+
+    def __init__(self, tokens: list[CancelToken | None], prompt_len: int, max_new_tokens: int):
+        self.tokens = tokens
+        self.prompt_len = prompt_len
+        self.max_new_tokens = max_new_tokens
+        self._stopped: set[int] = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        flags = []
+        for row, token in enumerate(self.tokens):
+            stop = token is not None and token.cancelled
+            if stop and row not in self._stopped:
+                self._stopped.add(row)
+                token.stopped(self.max_new_tokens - (input_ids.shape[1] - self.prompt_len))
+            flags.append(stop)
+        return torch.tensor(flags, dtype=torch.bool, device=input_ids.device)
+
+class _Timing:
+    """Wall-clock split of one generate call: prefill (up to the first token) and decode (the rest)."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first: float | None = None
+        self.end: float | None = None
+        self.steps = 0  # tokens generated per row, counting the first
+
+    def token(self):
+        self.steps += 1
+        if self.first is None:
+            self.first = time.perf_counter()
+
+    def finish(self):
+        self.end = time.perf_counter()
+        if self.first is None:
+            self.first = self.end
+
+    @property
+    def first_at(self) -> float:
+        return self.first or self.start
+
+    @property
+    def end_at(self) -> float:
+        return self.end or self.first_at
+
+class _TimingCriteria(StoppingCriteria):
+    """Never stops; model.generate calls it once per step, which is where the timing comes from."""
+
+    def __init__(self, timing: _Timing):
+        self.timing = timing
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.timing.token()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+def _stopping(tokens: list[CancelToken | None] | None, prompt_len: int, max_new_tokens: int, timing: _Timing | None = None) -> dict:
+    criteria = []
+    if timing is not None:
+        criteria.append(_TimingCriteria(timing))
+    if tokens and any(t is not None for t in tokens):
+        criteria.append(_CancelCriteria(tokens, prompt_len, max_new_tokens))
+    return {"stopping_criteria": StoppingCriteriaList(criteria)} if criteria else {}
+
+class _Completion(NamedTuple):
+    text: str  # generated text only, without the prompt
+    prompt_tokens: int
+    completion_tokens: int
+    timing: _Timing  # shared by every prompt that ran in the same call
+
+def _trim_eos(tokenizer, new_ids: list[int]) -> list[int]:
+    """Generated tokens up to and including the first EOS; the rest is padding."""
+    if tokenizer.eos_token_id in new_ids:
+        return new_ids[:new_ids.index(tokenizer.eos_token_id) + 1]
+    return new_ids
+
+def _completion(lm: "LoadedModel", prompt_ids: list[int], new_ids: list[int], timing: _Timing) -> _Completion:
+    new_ids = _trim_eos(lm.tokenizer, new_ids)
+    return _Completion(lm.tokenizer.decode(new_ids, skip_special_tokens=True), len(prompt_ids), len(new_ids), timing)
+
+# forward passes per thread, so a generate call can tell how many steps it took however many run at once
+_forwards = local()
+
+def _count_forwards(name: str):
+    def hook(module, args, output):
+        setattr(_forwards, name, getattr(_forwards, name, 0) + 1)
+    return hook
+
+def _forward_counts() -> tuple[int, int]:
+    return getattr(_forwards, "target", 0), getattr(_forwards, "draft", 0)
+
+def _use_draft(lm: "LoadedModel", request: GenerationRequest) -> bool:
+    return lm.draft is not None and request.speculative is not False
+
+class _SpeedTracker:
+    """Moving averages of one model's single-prompt throughput with and without its draft model."""
+
+    def __init__(self, name: str, enabled: bool, alpha: float = 0.1):
+        self.name = name
+        self.enabled = enabled
+        self.alpha = alpha
+        self._tps: dict[bool, float] = {}
+        self._lock = Lock()
+
+    def observe(self, speculative: bool, completion: _Completion):
+        seconds = completion.timing.end_at - completion.timing.start
+        if not self.enabled or seconds <= 0 or completion.completion_tokens < 2:
+            return
+        tps = completion.completion_tokens / seconds
+        with self._lock:
+            prev = self._tps.get(speculative)
+            self._tps[speculative] = tps if prev is None else prev + self.alpha * (tps - prev)
+            if True in self._tps and False in self._tps:
+                SPEC_SPEEDUP.labels(model=self.name).set(self._tps[True] / self._tps[False])
+
+def _forwards_since(before: tuple[int, int]) -> tuple[int, int]:
+    return tuple(after - start for after, start in zip(_forward_counts(), before))
+
+def _observe_speculative(lm: "LoadedModel", completion: _Completion, forwards: tuple[int, int]):
+    """Each target pass emits its accepted draft tokens plus one of its own."""
+    target, drafted = forwards
+    accepted = max(completion.completion_tokens - target, 0)
+    SPEC_DRAFT_TOKENS.inc(drafted)
+    SPEC_ACCEPTED_TOKENS.inc(accepted)
+    if drafted:
+        SPEC_ACCEPTANCE.observe(min(accepted / drafted, 1.0))
+    if target:
+        SPEC_TOKENS_PER_STEP.observe(completion.completion_tokens / target)
+    lm.speed.observe(True, completion)
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
+# set once the default model is loaded and warmed up in the background after startup
+_default_ready = Event()
+_default_error: str | None = None
+
+@app.get("/ready")
+def ready():
+    """200 once the default model is loaded and warm; /health only says the process is up."""
+    if not _default_ready.is_set():
+        detail = f"default model failed to load: {_default_error}" if _default_error else "default model is loading"
+        raise HTTPException(status_code=503, detail=detail)
+    # the gateway keys its response cache on these, so a swap stops it serving the old model's outputs
+    return {"ready": True, "default_model": DEFAULT_MODEL, "model_versions": registry.versions()}
+
 @app.get("/metrics")
 def metrics():
     return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
-@app.post("/generate")
-@GEN_TIME.time()
-def generate_text(request: GenerationRequest):
-    if not request.prompt:
-        raise HTTPException(status_code=400, detail="prompt must be a non-empty list")
-    if request.temperature is None or request.temperature <= 0 or request.temperature > 2.0:
-        raise HTTPException(status_code=400, detail="temperature must be > 0 and <= 2.0")
-    inputs = tokenizer(
-        request.prompt,
-        return_tensors="pt",
-        padding=True,
-        truncation=True,
+def _sse(payload: dict, event: str | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
+
+def _usage(lm: "LoadedModel", request: GenerationRequest, completions: list[_Completion]) -> dict:
+    # prompts may have run in several calls (buckets) or side by side (continuous engine):
+    # prefill is up to the request's first token, decode is everything after it
+    timings = [c.timing for c in completions]
+    prefill = decode = 0.0
+    if timings:
+        first = min(t.first_at for t in timings)
+        prefill = first - min(t.start for t in timings)
+        decode = max(t.end_at for t in timings) - first
+    prompt_tokens = sum(c.prompt_tokens for c in completions)
+    completion_tokens = sum(c.completion_tokens for c in completions)
+    # each prompt's first token is timed as prefill, so only the rest were produced in the decode window
+    decoded = completion_tokens - sum(1 for c in completions if c.completion_tokens)
+    return {
+        "model": lm.name,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "per_prompt": [
+            {
+                "prompt_tokens": c.prompt_tokens,
+                "completion_tokens": c.completion_tokens,
+                "total_tokens": c.prompt_tokens + c.completion_tokens,
+            }
+            for c in completions
+        ],
+        "prefill_ms": round(prefill * 1000, 1),
+        "decode_ms": round(decode * 1000, 1),
+        "tokens_per_second": round(decoded / decode, 2) if decode > 0 and decoded > 0 else None,
+        "prompt_count": len(request.prompt),
+        "max_new_tokens": request.max_new_tokens,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "deterministic": request.deterministic,
+        "seed": request.seed,
+    }
+
+def _observe_usage(usage: dict):
+    MODEL_REQUESTS.labels(model=usage["model"]).inc()
+    MODEL_GENERATED_TOKENS.labels(model=usage["model"]).inc(usage["completion_tokens"])
+    PROMPT_TOKENS.observe(usage["prompt_tokens"])
+    COMPLETION_TOKENS.observe(usage["completion_tokens"])
+    PREFILL_TIME.observe(usage["prefill_ms"] / 1000)
+    DECODE_TIME.observe(usage["decode_ms"] / 1000)
+    if usage["tokens_per_second"] is not None:
+        DECODE_TPS.observe(usage["tokens_per_second"])
+
+class _SeededSampler(LogitsProcessor):
+    """Draws every token of a seeded request from its own torch.Generator, like the continuous engine.
+
+    generate() applies custom processors before its temperature/top-p warpers and then samples from the
+    global RNG, so this one samples itself and leaves only the drawn token possible.
+    """
+
+    def __init__(self, request: GenerationRequest):
+        self.request = request
+        self.generator = torch.Generator(device=device).manual_seed(request.seed)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        picked = [[_sample_next(row, self.request, self.generator)] for row in scores]
+        return torch.full_like(scores, float("-inf")).scatter_(-1, torch.tensor(picked, device=scores.device), 0.0)
+
+def _sampling_kwargs(request: GenerationRequest) -> dict:
+    if request.deterministic:
+        return {"do_sample": False}
+    kwargs = {"do_sample": True, "temperature": request.temperature, "top_p": request.top_p}
+    if request.seed is not None:
+        # torch.manual_seed would reset the RNG that concurrent requests are sampling from
+        kwargs["logits_processor"] = LogitsProcessorList([_SeededSampler(request)])
+    return kwargs
+
+class GuardedStreamingResponse(StreamingResponse):
+    """StreamingResponse that always runs `cleanup`, even when the client leaves before the body starts."""
+
+    def __init__(self, content, cleanup, **kwargs):
+        super().__init__(content, **kwargs)
+        self.cleanup = cleanup
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.cleanup()
+
+def _stream_generation(lm: "LoadedModel", inputs, request: GenerationRequest, on_done=None, cancel: CancelToken | None = None):
+    """Run model.generate in a worker thread and yield SSE events as text arrives."""
+    streamer = TextIteratorStreamer(lm.tokenizer, skip_prompt=True, skip_special_tokens=True)
+    timing = _Timing()
+    prompt_len = inputs["input_ids"].shape[1]
+
+    speculative = _use_draft(lm, request)
+    generated: list[list[int]] = []
+    forwards: list[tuple[int, int]] = []
+    errors: list[BaseException] = []
+
+    def run():
+        before = _forward_counts()
+        try:
+            with torch.inference_mode():
+                output = lm.model.generate(
+                    **inputs,
+                    max_new_tokens=request.max_new_tokens,
+                    pad_token_id=lm.tokenizer.eos_token_id,
+                    streamer=streamer,
+                    assistant_model=lm.draft if speculative else None,
+                    **_sampling_kwargs(request),
+                    **_stopping([cancel], prompt_len, request.max_new_tokens, timing),
+                )
+            generated.append(_trim_eos(lm.tokenizer, output[0, prompt_len:].tolist()))
+            forwards.append(_forwards_since(before))
+        except BaseException as e:
+            # generate() never reached streamer.end(), so unblock the consumer ourselves
+            errors.append(e)
+            streamer.end()
+        finally:
+            timing.finish()
+            # the slot is held until the model is done, even if the client left early
+            if on_done is not None:
+                on_done()
+
+    worker = Thread(target=run, daemon=True)
+    worker.start()
+    pieces = []
+    try:
+        for text in streamer:
+            if text:
+                pieces.append(text)
+                yield _sse({"text": text})
+        worker.join()
+    finally:
+        # generator closed early: the client went away, so stop decoding
+        if cancel is not None and worker.is_alive():
+            cancel.cancel("client")
+        if cancel is not None:
+            cancellations.unregister(cancel)
+    if errors:
+        yield _sse({"error": f"Generation failed: {errors[0]}"}, event="error")
+        return
+    # a speculative step can emit several tokens, so count them from the output rather than the steps
+    completion = _Completion("".join(pieces), prompt_len, len(generated[0]) if generated else timing.steps, timing)
+    if speculative and forwards:
+        _observe_speculative(lm, completion, forwards[0])
+    else:
+        lm.speed.observe(False, completion)
+    usage = _usage(lm, request, [completion])
+    _observe_usage(usage)
+    done = {"done": True, "generated_text": completion.text, "usage": usage}
+    if cancel is not None and cancel.triggered:
+        done["cancelled"] = cancel.reason
+    yield _sse(done)
+
+def _cache_layers(cache) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v, *_ in cache]
+
+def _make_cache(layers: list[tuple[torch.Tensor, torch.Tensor]]):
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(layers)
+
+class PrefixCache:
+    """LRU of token-prefix -> KV tensors for prompts that keep starting the same way.
+
+    Prefixes are tracked at PREFIX_BLOCK_TOKENS boundaries; a boundary's KV is only
+    stored once that prefix has been seen PREFIX_MIN_SEEN times, so one-off prompts
+    do not churn the cache. Entries hold batch-1 tensors shaped [1, heads, n, dim].
+    """
+
+    def __init__(self, name: str, max_bytes: int, block: int, min_seen: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.block = block
+        self.min_seen = min_seen
+        self._entries: OrderedDict[tuple, tuple[list, int]] = OrderedDict()
+        self._seen: OrderedDict[int, int] = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 and self.block > 0
+
+    def _boundaries(self, length: int):
+        # keep at least one prompt token uncached so there are logits to sample from
+        return range(self.block * ((length - 1) // self.block), 0, -self.block)
+
+    def lookup(self, ids: list[int]) -> tuple[int, list | None]:
+        if self.enabled:
+            with self._lock:
+                for n in self._boundaries(len(ids)):
+                    entry = self._entries.get(tuple(ids[:n]))
+                    if entry is not None:
+                        self._entries.move_to_end(tuple(ids[:n]))
+                        PREFIX_LOOKUPS.labels(result="hit").inc()
+                        PREFIX_TOKENS_SAVED.inc(n)
+                        return n, entry[0]
+        PREFIX_LOOKUPS.labels(result="miss").inc()
+        return 0, None
+
+    def observe(self, ids: list[int], layers: list, cached: int):
+        """Count this prompt's prefixes and store the longest popular one not already cached."""
+        if not self.enabled or not layers:
+            return
+        with self._lock:
+            for n in self._boundaries(len(ids)):
+                if n <= cached:
+                    return
+                h = hash(tuple(ids[:n]))
+                count = self._seen.pop(h, 0) + 1
+                self._seen[h] = count
+                if len(self._seen) > 100_000:
+                    self._seen.popitem(last=False)
+                if count >= self.min_seen:
+                    self._store(tuple(ids[:n]), [(k[:1, :, :n].clone(), v[:1, :, :n].clone()) for k, v in layers])
+                    return
+
+    def _store(self, key: tuple, layers: list):
+        size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = (layers, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, old) = self._entries.popitem(last=False)
+            self._bytes -= old
+        PREFIX_BYTES.labels(model=self.name).set(self._bytes)
+
+def _prefill(lm: "LoadedModel", ids: list[int]):
+    """Encode one prompt, resuming from a cached prefix when there is one."""
+    cached, layers = lm.prefix_cache.lookup(ids)
+    if cached:
+        out = lm.model(input_ids=torch.tensor([ids[cached:]], device=device), past_key_values=_make_cache(layers), use_cache=True)
+    else:
+        out = lm.model(input_ids=torch.tensor([ids], device=device), use_cache=True)
+    full = _cache_layers(out.past_key_values)
+    lm.prefix_cache.observe(ids, full, cached)
+    return out.logits[0, -1], full
+
+def _run_single_with_prefix(lm: "LoadedModel", prompt: str, params: GenerationRequest, cancel: list | None = None) -> _Completion:
+    ids = lm.tokenizer(prompt, truncation=True)["input_ids"]
+    timing = _Timing()
+    cached, layers = lm.prefix_cache.lookup(ids)
+    input_ids = torch.tensor([ids], device=device)
+    output = lm.model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        past_key_values=_make_cache(layers) if cached else None,
+        max_new_tokens=params.max_new_tokens,
+        pad_token_id=lm.tokenizer.eos_token_id,
+        return_dict_in_generate=True,
+        **_sampling_kwargs(params),
+        **_stopping(cancel, len(ids), params.max_new_tokens, timing),
+    )
+    timing.finish()
+    if output.past_key_values is not None:
+        lm.prefix_cache.observe(ids, _cache_layers(output.past_key_values), cached)
+    return _completion(lm, ids, output.sequences[0, len(ids):].tolist(), timing)
+
+def _run_speculative(lm: "LoadedModel", prompt: str, params: GenerationRequest, cancel: list | None = None) -> _Completion:
+    """Single prompt with the draft model proposing tokens; the prefix cache is bypassed here."""
+    ids = lm.tokenizer(prompt, truncation=True)["input_ids"]
+    timing = _Timing()
+    before = _forward_counts()
+    input_ids = torch.tensor([ids], device=device)
+    output = lm.model.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        assistant_model=lm.draft,
+        max_new_tokens=params.max_new_tokens,
+        pad_token_id=lm.tokenizer.eos_token_id,
+        **_sampling_kwargs(params),
+        **_stopping(cancel, len(ids), params.max_new_tokens, timing),
     )
+    timing.finish()
+    completion = _completion(lm, ids, output[0, len(ids):].tolist(), timing)
+    _observe_speculative(lm, completion, _forwards_since(before))
+    return completion
+
+def _length_buckets(lengths: list[int]) -> list[list[int]]:
+    """Group prompt indices by token length, splitting where the longest would pad the shortest too much."""
+    if not LENGTH_BUCKETING or len(lengths) < 2:
+        return [list(range(len(lengths)))]
+    buckets, current = [], []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        shortest = lengths[current[0]] if current else 0
+        if current and lengths[i] > shortest * LENGTH_BUCKET_RATIO and lengths[i] - shortest >= LENGTH_BUCKET_MIN_GAP:
+            buckets.append(current)
+            current = []
+        current.append(i)
+    buckets.append(current)
+    return buckets
+
+def _generate_padded(lm: "LoadedModel", ids: list[list[int]], params: GenerationRequest, cancel: list | None) -> list[_Completion]:
+    timing = _Timing()
+    inputs = lm.tokenizer.pad({"input_ids": ids}, padding=True, return_tensors="pt")
     inputs = {k: v.to(device) for k, v in inputs.items()}
+    BATCH_SIZE.observe(len(ids))
+    BATCH_PADDING_RATIO.observe(1.0 - float(inputs["attention_mask"].sum()) / inputs["attention_mask"].numel())
+    output = lm.model.generate(
+        **inputs,
+        max_new_tokens=params.max_new_tokens,
+        pad_token_id=lm.tokenizer.eos_token_id,
+        **_sampling_kwargs(params),
+        **_stopping(cancel, inputs["input_ids"].shape[1], params.max_new_tokens, timing),
+    )
+    timing.finish()
+    width = inputs["input_ids"].shape[1]
+    return [_completion(lm, ids[i], output[i, width:].tolist(), timing) for i in range(len(ids))]
+
+def _run_generate(lm: "LoadedModel", prompts: list[str], params: GenerationRequest, cancel: list | None = None) -> list[_Completion]:
+    """Generate for prompts that may span requests; sampling settings come from params.
+
+    cancel holds one CancelToken (or None) per prompt; cancelled rows stop decoding early.
+    Prompts of very different lengths run as separate sub-batches and come back in input order.
+    A lone prompt uses the draft model when speculative decoding is on.
+    """
+    if len(prompts) == 1 and (lm.prefix_cache.enabled or _use_draft(lm, params)):
+        BATCH_SIZE.observe(1)
+        with torch.inference_mode():
+            if _use_draft(lm, params):
+                return [_run_speculative(lm, prompts[0], params, cancel)]
+            completion = _run_single_with_prefix(lm, prompts[0], params, cancel)
+        lm.speed.observe(False, completion)
+        return [completion]
+    ids = lm.tokenizer(prompts, truncation=True)["input_ids"]
+    results: list[_Completion | None] = [None] * len(prompts)
     with torch.inference_mode():
-        output = model.generate(
-            **inputs,
-            max_new_tokens=request.max_new_tokens,
-            do_sample=True,
-            temperature=request.temperature,
-            top_p=request.top_p,
-            pad_token_id=tokenizer.eos_token_id,
+        for bucket in _length_buckets([len(x) for x in ids]):
+            completions = _generate_padded(
+                lm,
+                [ids[i] for i in bucket],
+                params,
+                [cancel[i] for i in bucket] if cancel else None,
+            )
+            for i, completion in zip(bucket, completions):
+                results[i] = completion
+    if len(prompts) == 1:
+        lm.speed.observe(False, results[0])
+    return results
+
+def _batch_key(request: GenerationRequest, owner, speculative: bool) -> tuple:
+    # requests that opted out of the draft model never share a batch that might run speculatively
+    if request.deterministic:
+        return (request.max_new_tokens, "greedy", speculative)
+    if request.seed is not None:
+        # a seed only reproduces if the prompts run alone, so seeded requests get their own group
+        return (request.max_new_tokens, "seeded", id(owner))
+    return (request.max_new_tokens, request.temperature, request.top_p, speculative)
+
+class _Pending:
+    def __init__(self, request: GenerationRequest, cancel: CancelToken | None = None, speculative: bool = False):
+        self.request = request
+        self.cancel = cancel
+        self.key = _batch_key(request, self, speculative)
+        self.enqueued_at = time.monotonic()
+        self.future: Future = Future()
+
+class BatchScheduler:
+    """Collects requests for one model for a short window and runs compatible ones as one padded batch."""
+
+    def __init__(self, lm: "LoadedModel", max_size: int, max_wait_ms: float):
+        self.lm = lm
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: queue.Queue[_Pending | None] = queue.Queue()
+        self._stopped = False
+        self._thread = Thread(target=self._loop, name=f"batch-scheduler-{lm.name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Let the thread exit once the queue is drained; the model is idle by the time this is called."""
+        self._queue.put(None)
+
+    def submit(self, request: GenerationRequest, cancel: CancelToken | None = None) -> list[_Completion]:
+        pending = _Pending(request, cancel, _use_draft(self.lm, request))
+        self._queue.put(pending)
+        return pending.future.result()
+
+    def _collect(self) -> list[_Pending]:
+        item = self._queue.get()
+        if item is None:
+            self._stopped = True
+            return []
+        items = [item]
+        prompts = len(item.request.prompt)
+        deadline = time.monotonic() + self.max_wait
+        while prompts < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopped = True
+                break
+            items.append(item)
+            prompts += len(item.request.prompt)
+        return items
+
+    def _loop(self):
+        while not self._stopped:
+            groups: dict[tuple, list[_Pending]] = {}
+            for item in self._collect():
+                groups.setdefault(item.key, []).append(item)
+            for items in groups.values():
+                # split oversized groups so no single call exceeds max_size prompts
+                batch: list[_Pending] = []
+                count = 0
+                for item in items:
+                    if batch and count + len(item.request.prompt) > self.max_size:
+                        self._run(batch)
+                        batch, count = [], 0
+                    batch.append(item)
+                    count += len(item.request.prompt)
+                if batch:
+                    self._run(batch)
+
+    def _run(self, batch: list[_Pending]):
+        started = time.monotonic()
+        live = []
+        for item in batch:
+            BATCH_QUEUE_WAIT.observe(started - item.enqueued_at)
+            if item.cancel is not None and item.cancel.cancelled:
+                # cancelled while queued: never reaches the model
+                item.cancel.stopped(item.request.max_new_tokens * len(item.request.prompt))
+                item.future.set_result([])
+            else:
+                live.append(item)
+        if not live:
+            return
+        batch = live
+        prompts = [p for item in batch for p in item.request.prompt]
+        cancel = [item.cancel for item in batch for _ in item.request.prompt]
+        try:
+            completions = _run_generate(self.lm, prompts, batch[0].request, cancel)
+        except Exception as e:
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        offset = 0
+        for item in batch:
+            n = len(item.request.prompt)
+            item.future.set_result(completions[offset:offset + n])
+            offset += n
+
+# --- continuous batching -------------------------------------------------
+# The engine keeps one left-padded KV cache for every active sequence and runs a
+# single forward pass per decode step. New sequences are prefilled on their own
+# and spliced into the batch between steps; finished rows are dropped right away.
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - t.shape[dim]
+    if missing <= 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = missing
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+def _sample_next(logits: torch.Tensor, request: GenerationRequest, generator: torch.Generator | None = None) -> int:
+    if request.deterministic:
+        return int(torch.argmax(logits))
+    top_p = request.top_p
+    probs = torch.softmax(logits.float() / request.temperature, dim=-1)
+    if top_p < 1.0:
+        sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        sorted_probs[(cumulative - sorted_probs) > top_p] = 0.0
+        probs = torch.zeros_like(probs).scatter_(-1, sorted_idx, sorted_probs)
+    return int(torch.multinomial(probs, 1, generator=generator))
+
+class _Job:
+    """One HTTP request; resolves once all of its prompts have finished."""
+
+    def __init__(self, request: GenerationRequest, cancel: CancelToken | None = None):
+        self.request = request
+        self.cancel = cancel
+        self.results: list[_Completion | None] = [None] * len(request.prompt)
+        self.remaining = len(request.prompt)
+        self.future: Future = Future()
+
+class _Sequence:
+    def __init__(self, job: _Job, index: int, prompt_ids: list[int], eos_token_id: int):
+        self.job = job
+        self.index = index
+        self.prompt_ids = prompt_ids
+        self.eos_token_id = eos_token_id
+        self.generated: list[int] = []
+        self.timing = _Timing()  # from admission; decode time is time spent in the shared batch
+        self.generator: torch.Generator | None = None
+        if job.request.seed is not None:
+            self.generator = torch.Generator(device=device).manual_seed(job.request.seed)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.job.cancel is not None and self.job.cancel.cancelled
+
+    @property
+    def done(self) -> bool:
+        return (
+            len(self.generated) >= self.job.request.max_new_tokens
+            or (bool(self.generated) and self.generated[-1] == self.eos_token_id)
+            or self.cancelled
+        )
+
+class ContinuousBatchingEngine:
+    def __init__(self, lm: "LoadedModel", max_active: int):
+        self.lm = lm
+        self.max_active = max_active
+        self._waiting: queue.Queue[_Sequence | None] = queue.Queue()
+        self._active: list[_Sequence] = []
+        self._kv: list[tuple[torch.Tensor, torch.Tensor]] = []
+        self._mask: torch.Tensor | None = None  # [batch, cache_len], 0 = padding
+        self._tokens_window = 0
+        self._window_start = time.monotonic()
+        self._stopped = False
+        self._thread = Thread(target=self._loop, name=f"continuous-engine-{lm.name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Let the thread exit; the model is idle by the time this is called."""
+        self._waiting.put(None)
+
+    def submit(self, request: GenerationRequest, cancel: CancelToken | None = None) -> list[_Completion]:
+        job = _Job(request, cancel)
+        for i, prompt in enumerate(request.prompt):
+            ids = self.lm.tokenizer(prompt, truncation=True)["input_ids"]
+            self._waiting.put(_Sequence(job, i, ids, self.lm.tokenizer.eos_token_id))
+        ENGINE_QUEUE_DEPTH.labels(model=self.lm.name).set(self._waiting.qsize())
+        return job.future.result()
+
+    def _loop(self):
+        with torch.inference_mode():
+            while not self._stopped:
+                try:
+                    if not self._active:
+                        self._try_admit(self._waiting.get())
+                    while len(self._active) < self.max_active and not self._waiting.empty():
+                        self._try_admit(self._waiting.get_nowait())
+                    ENGINE_QUEUE_DEPTH.labels(model=self.lm.name).set(self._waiting.qsize())
+                    if self._active:
+                        self._step()
+                except Exception as e:
+                    self._fail_all(e)
+
+    def _try_admit(self, seq: _Sequence | None):
+        if seq is None:
+            self._stopped = True
+            return
+        try:
+            self._admit(seq)
+        except Exception as e:
+            if not seq.job.future.done():
+                seq.job.future.set_exception(e)
+
+    def _admit(self, seq: _Sequence):
+        if seq.cancelled:
+            self._finish(seq)
+            return
+        seq.timing = _Timing()
+        logits, layers = _prefill(self.lm, seq.prompt_ids)
+        seq.generated.append(_sample_next(logits, seq.job.request, seq.generator))
+        seq.timing.token()
+        self._count_tokens(1)
+        if seq.done:
+            self._finish(seq)
+            return
+        mask = torch.ones((1, len(seq.prompt_ids)), dtype=torch.long, device=device)
+        if not self._active:
+            self._kv, self._mask = layers, mask
+        else:
+            length = max(self._mask.shape[1], mask.shape[1])
+            self._kv = [
+                (torch.cat([_left_pad(k0, length, 2), _left_pad(k1, length, 2)]),
+                 torch.cat([_left_pad(v0, length, 2), _left_pad(v1, length, 2)]))
+                for (k0, v0), (k1, v1) in zip(self._kv, layers)
+            ]
+            self._mask = torch.cat([_left_pad(self._mask, length, 1), _left_pad(mask, length, 1)])
+        self._active.append(seq)
+        ENGINE_ACTIVE.labels(model=self.lm.name).set(len(self._active))
+
+    def _step(self):
+        last = torch.tensor([[s.generated[-1]] for s in self._active], device=device)
+        positions = self._mask.sum(dim=1, keepdim=True)
+        mask = torch.cat([self._mask, self._mask.new_ones((len(self._active), 1))], dim=1)
+        out = self.lm.model(
+            input_ids=last,
+            attention_mask=mask,
+            position_ids=positions,
+            past_key_values=_make_cache(self._kv),
+            use_cache=True,
         )
+        self._kv, self._mask = _cache_layers(out.past_key_values), mask
+        for row, seq in enumerate(self._active):
+            seq.generated.append(_sample_next(out.logits[row, -1], seq.job.request, seq.generator))
+            seq.timing.token()
+        self._count_tokens(len(self._active))
+        keep = [i for i, s in enumerate(self._active) if not s.done]
+        if len(keep) == len(self._active):
+            return
+        for seq in self._active:
+            if seq.done:
+                self._finish(seq)
+        self._retain(keep)
+
+    def _retain(self, keep: list[int]):
+        self._active = [self._active[i] for i in keep]
+        ENGINE_ACTIVE.labels(model=self.lm.name).set(len(self._active))
+        if not self._active:
+            self._kv, self._mask = [], None
+            return
+        idx = torch.tensor(keep, device=device)
+        mask = self._mask.index_select(0, idx)
+        # drop columns that are padding for every remaining row
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        self._mask = mask[:, start:]
+        self._kv = [(k.index_select(0, idx)[:, :, start:], v.index_select(0, idx)[:, :, start:]) for k, v in self._kv]
+
+    def _finish(self, seq: _Sequence):
+        job = seq.job
+        if seq.cancelled:
+            job.cancel.stopped(job.request.max_new_tokens - len(seq.generated))
+        seq.timing.finish()
+        job.results[seq.index] = _completion(self.lm, seq.prompt_ids, seq.generated, seq.timing)
+        job.remaining -= 1
+        if job.remaining == 0 and not job.future.done():
+            job.future.set_result(job.results)
+
+    def _fail_all(self, e: Exception):
+        for seq in self._active:
+            if not seq.job.future.done():
+                seq.job.future.set_exception(e)
+        self._active, self._kv, self._mask = [], [], None
+        ENGINE_ACTIVE.labels(model=self.lm.name).set(0)
+
+    def _count_tokens(self, n: int):
+        ENGINE_TOKENS.inc(n)
+        self._tokens_window += n
+        now = time.monotonic()
+        if now - self._window_start >= 1.0:
+            ENGINE_TPS.labels(model=self.lm.name).set(self._tokens_window / (now - self._window_start))
+            self._tokens_window, self._window_start = 0, now
+
+# --- model registry --------------------------------------------------------
+
+_SAFETENSORS_DTYPES = {torch.float32: "F32", torch.bfloat16: "BF16", torch.float16: "F16"}
+
+def _warmup(lm: "LoadedModel"):
+    """Greedy-generate over every WARMUP_BATCH_SIZES x WARMUP_LENGTHS shape, with the draft where it applies."""
+    limit = getattr(lm.model.config, "max_position_embeddings", None) or 4096
+    generator = torch.Generator().manual_seed(0)
+    with torch.inference_mode():
+        for batch in WARMUP_BATCH_SIZES:
+            for length in WARMUP_LENGTHS:
+                length = min(length, limit - WARMUP_NEW_TOKENS)
+                if length < 1 or batch < 1:
+                    continue
+                ids = torch.randint(0, lm.model.config.vocab_size, (batch, length), generator=generator).to(device)
+                lm.model.generate(
+                    input_ids=ids,
+                    attention_mask=torch.ones_like(ids),
+                    max_new_tokens=WARMUP_NEW_TOKENS,
+                    min_new_tokens=WARMUP_NEW_TOKENS,
+                    do_sample=False,
+                    pad_token_id=lm.tokenizer.eos_token_id,
+                    assistant_model=lm.draft if batch == 1 else None,
+                )
+
+class LoadedModel:
+    """A resident model with everything specific to it: tokenizer, draft, prefix cache and batcher."""
+
+    def __init__(self, name: str, source: str, revision: str | None = None, on_warmup=None):
+        t0 = time.perf_counter()
+        rss_before = _proc_status_bytes("VmRSS") if _reset_peak_rss() else None
+        self.name = name
+        self.source = source
+        self.revision = revision
+        self.stored_dtype = _stored_dtype(source)
+        self.tokenizer = AutoTokenizer.from_pretrained(source, padding_side="left", revision=revision)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model, self.backend = _load_model(source, INFERENCE_BACKEND, revision)
+        self.draft_repo = _draft_repo(name)
+        self.draft = None
+        if self.draft_repo:
+            draft_source = _local_model_dir(self.draft_repo) or self.draft_repo
+            # the target verifies draft token ids directly, so both must tokenize identically
+            if AutoTokenizer.from_pretrained(draft_source).get_vocab() != self.tokenizer.get_vocab():
+                raise RuntimeError(f"draft model {self.draft_repo} does not share the tokenizer of {name}")
+            if self.backend == "compile":
+                raise RuntimeError("speculative decoding needs a dynamic KV cache; pick another INFERENCE_BACKEND")
+            self.draft, _ = _load_model(draft_source, self.backend)
+            self.model.register_forward_hook(_count_forwards("target"))
+            self.draft.register_forward_hook(_count_forwards("draft"))
+        # parameters still backed by the checkpoint's pages; int8 re-packs the Linear weights anyway
+        self.zero_copy = self.backend != "int8" and self.stored_dtype == _SAFETENSORS_DTYPES.get(next(self.model.parameters()).dtype)
+        peak = _proc_status_bytes("VmHWM")
+        self.load_peak_rss = peak - rss_before if peak is not None and rss_before is not None else None
+        self.load_seconds = time.perf_counter() - t0
+        if on_warmup is not None:
+            on_warmup()
+        t0 = time.perf_counter()
+        _warmup(self)
+        self.warmup_seconds = time.perf_counter() - t0
+        # the compiled backend decodes into a preallocated static cache, which cannot be seeded with prefix KV
+        self.prefix_cache = PrefixCache(
+            name, 0 if self.backend == "compile" else PREFIX_CACHE_MAX_BYTES, PREFIX_BLOCK_TOKENS, PREFIX_MIN_SEEN,
+        )
+        self.speed = _SpeedTracker(name, self.draft is not None)
+        self.weight_bytes = _model_bytes(self.model) + (_model_bytes(self.draft) if self.draft is not None else 0)
+        self.runner = None
+        if ENGINE_MODE == "continuous":
+            self.runner = ContinuousBatchingEngine(self, ENGINE_MAX_ACTIVE)
+        elif BATCH_ENABLED:
+            self.runner = BatchScheduler(self, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+        if self.runner is not None:
+            self.runner.start()
+        self.inflight = 0
+        self.draining = False  # replaced by a hot swap; finishing its in-flight generations
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+    def generate(self, request: GenerationRequest, cancel: CancelToken | None) -> list[_Completion]:
+        if self.runner is not None:
+            return self.runner.submit(request, cancel)
+        return _run_generate(self, request.prompt, request, [cancel] * len(request.prompt))
+
+    def close(self):
+        if self.runner is not None:
+            self.runner.stop()
+        self.model = self.draft = self.prefix_cache = None
+
+    def describe(self) -> dict:
+        return {
+            "name": self.name,
+            "source": self.source,
+            "revision": self.revision,
+            "backend": self.backend,
+            "dtype": str(next(self.model.parameters()).dtype),
+            "weight_bytes": self.weight_bytes,
+            "speculative_draft": self.draft_repo,
+            "stored_dtype": self.stored_dtype,
+            "zero_copy": self.zero_copy,
+            "load_seconds": round(self.load_seconds, 2),
+            "load_peak_rss_bytes": self.load_peak_rss,
+            "warmup_seconds": round(self.warmup_seconds, 2),
+            "loaded_at": self.loaded_at,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+            "inflight": self.inflight,
+            "draining": self.draining,
+        }
+
+class ModelSwap:
+    """Progress of one hot swap: loading -> warming -> draining -> done (or failed)."""
+
+    def __init__(self, name: str, source: str, revision: str | None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.source = source
+        self.revision = revision
+        self.state = "loading"
+        self.error: str | None = None
+        self.started_at = time.time()
+        self.load_seconds: float | None = None
+        self.warmup_seconds: float | None = None
+        self.drain_seconds: float | None = None
+        self.total_seconds: float | None = None
+        self.old: LoadedModel | None = None  # the replaced model while it drains
+
+    @property
+    def active(self) -> bool:
+        return self.state not in ("done", "failed")
+
+    def describe(self) -> dict:
+        def r(x):
+            return None if x is None else round(x, 2)
+        return {
+            "id": self.id,
+            "model": self.name,
+            "source": self.source,
+            "revision": self.revision,
+            "state": self.state,
+            "error": self.error,
+            "started_at": self.started_at,
+            "elapsed_seconds": r(self.total_seconds if self.total_seconds is not None else time.time() - self.started_at),
+            "load_seconds": r(self.load_seconds),
+            "warmup_seconds": r(self.warmup_seconds),
+            "drain_seconds": r(self.drain_seconds),
+            "draining_inflight": self.old.inflight if self.old is not None else 0,
+        }
+
+class ModelRegistry:
+    """Loads models on first use and keeps the recently used ones resident within a weight budget.
+
+    Callers pair acquire() with release(); a model is only evicted while nothing holds it. The
+    budget is checked against an estimate before loading and against the real size afterwards.
+    swap() replaces a served model without downtime: the replacement loads and warms beside it,
+    new acquires switch over in one step, and the old model is freed once its holders release it.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._models: OrderedDict[str, LoadedModel] = OrderedDict()  # least recently used first
+        self._loading: dict[str, Future] = {}
+        self._sources: dict[str, tuple[str, str | None]] = {}  # name -> (source, revision) set by swaps
+        self._versions: dict[str, str] = {}  # name -> id of the swap that installed its current weights
+        self._draining: list[LoadedModel] = []
+        self._swaps: OrderedDict[str, ModelSwap] = OrderedDict()
+        self._reserved = 0  # budget held for memory used outside the registry, e.g. backend comparisons
+        self._lock = Lock()
+        self._drained = Condition(self._lock)
+
+    def acquire(self, name: str) -> LoadedModel:
+        while True:
+            with self._lock:
+                lm = self._models.get(name)
+                if lm is not None:
+                    self._models.move_to_end(name)
+                    lm.inflight += 1
+                    lm.last_used = time.monotonic()
+                    MODEL_INFLIGHT.labels(model=name).set(lm.inflight)
+                    return lm
+                loading = self._loading.get(name)
+                owner = loading is None
+                if owner:
+                    loading = self._loading[name] = Future()
+            if not owner:
+                loading.result()  # another request is loading it; raises if that load failed
+                continue
+            try:
+                self._load(name)
+            except BaseException as e:
+                loading.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._loading[name]
+            loading.set_result(None)
+
+    def release(self, lm: LoadedModel):
+        with self._lock:
+            lm.inflight -= 1
+            lm.last_used = time.monotonic()
+            if lm.draining:
+                MODEL_DRAINING.labels(model=lm.name).set(lm.inflight)
+                if not lm.inflight:
+                    self._drained.notify_all()
+            else:
+                MODEL_INFLIGHT.labels(model=lm.name).set(lm.inflight)
+
+    def _load(self, name: str):
+        source, revision = self._sources.get(name) or (_model_source(name), None)
+        self._make_room(_estimate_model_bytes(name, source, revision), keep=name)
+        lm = LoadedModel(name, source, revision)
+        with self._lock:
+            # a swap may have installed a replacement while this load ran; that one wins
+            stale = name in self._models
+            if not stale:
+                self._models[name] = lm
+        if stale:
+            lm.close()
+            return
+        self._observe_loaded(lm)
+        if name == DEFAULT_MODEL:
+            _default_ready.set()  # any later load recovers a default model whose preload failed
+        self._make_room(0, keep=name, strict=False)
+
+    @staticmethod
+    def _observe_loaded(lm: LoadedModel):
+        MODEL_LOAD_TIME.labels(model=lm.name).observe(lm.load_seconds)
+        MODEL_WARMUP_TIME.labels(model=lm.name).observe(lm.warmup_seconds)
+        if lm.load_peak_rss is not None:
+            MODEL_LOAD_PEAK_RSS.labels(model=lm.name).set(lm.load_peak_rss)
+        MODEL_RESIDENT.labels(model=lm.name).set(1)
+        MODEL_RESIDENT_BYTES.labels(model=lm.name).set(lm.weight_bytes)
+
+    def swap(self, name: str, source_name: str, revision: str | None = None) -> ModelSwap:
+        """Start replacing name with a model loaded from source_name in the background."""
+        _check_model_name(name)
+        source = _model_source(source_name)
+        if revision is not None and source != source_name:
+            raise HTTPException(status_code=400, detail="revision only applies to models fetched from the Hub")
+        with self._lock:
+            if any(s.active and s.name == name for s in self._swaps.values()):
+                raise HTTPException(status_code=409, detail=f"a swap of {name} is already running")
+            swap = ModelSwap(name, source, revision)
+            self._swaps[swap.id] = swap
+            finished = [k for k, s in self._swaps.items() if not s.active]
+            for k in finished[:max(len(finished) - MODEL_SWAP_HISTORY, 0)]:
+                del self._swaps[k]
+        Thread(target=self._run_swap, args=(swap,), name=f"swap-{name}", daemon=True).start()
+        return swap
+
+    def _run_swap(self, swap: ModelSwap):
+        t0 = time.perf_counter()
+        try:
+            self._make_room(_estimate_model_bytes(swap.name, swap.source, swap.revision), keep=swap.name)
+
+            def warming():
+                swap.state = "warming"
+            lm = LoadedModel(swap.name, swap.source, swap.revision, on_warmup=warming)
+        except Exception as e:
+            swap.error = getattr(e, "detail", None) or repr(e)
+            swap.state = "failed"
+            swap.total_seconds = time.perf_counter() - t0
+            MODEL_SWAPS.labels(model=swap.name, result="failed").inc()
+            return
+        swap.load_seconds, swap.warmup_seconds = lm.load_seconds, lm.warmup_seconds
+        MODEL_SWAP_TIME.labels(model=swap.name, phase="load").observe(lm.load_seconds)
+        MODEL_SWAP_TIME.labels(model=swap.name, phase="warmup").observe(lm.warmup_seconds)
+        with self._lock:
+            old = self._models.pop(swap.name, None)
+            self._models[swap.name] = lm
+            self._sources[swap.name] = (swap.source, swap.revision)
+            self._versions[swap.name] = swap.id
+            if old is not None:
+                old.draining = True
+                self._draining.append(old)
+                swap.old = old
+                MODEL_DRAINING.labels(model=swap.name).set(old.inflight)
+            MODEL_INFLIGHT.labels(model=swap.name).set(lm.inflight)
+            swap.state = "draining"
+        self._observe_loaded(lm)
+        if swap.name == DEFAULT_MODEL:
+            _default_ready.set()  # a swap can also recover a default model that failed to load
+        t1 = time.perf_counter()
+        if old is not None:
+            with self._lock:
+                while old.inflight:
+                    self._drained.wait()
+                self._draining.remove(old)
+                swap.old = None
+            old.close()
+            gc.collect()
+        swap.drain_seconds = time.perf_counter() - t1
+        swap.total_seconds = time.perf_counter() - t0
+        swap.state = "done"
+        MODEL_SWAP_TIME.labels(model=swap.name, phase="drain").observe(swap.drain_seconds)
+        MODEL_SWAP_TIME.labels(model=swap.name, phase="total").observe(swap.total_seconds)
+        MODEL_SWAPS.labels(model=swap.name, result="ok").inc()
+        self._make_room(0, keep=swap.name, strict=False)
+
+    def versions(self) -> dict[str, str]:
+        """Which swap each hot-swapped model came from; models still on their startup weights are absent."""
+        with self._lock:
+            return dict(self._versions)
+
+    def get_swap(self, swap_id: str) -> ModelSwap | None:
+        with self._lock:
+            return self._swaps.get(swap_id)
+
+    def describe_swaps(self) -> list[dict]:
+        with self._lock:
+            swaps = list(self._swaps.values())
+        return [s.describe() for s in swaps]
+
+    def reserve(self, nbytes: int):
+        """Hold nbytes of the budget for memory the registry does not own; pair with unreserve()."""
+        self._make_room(nbytes, keep=None, reserve=True)
+
+    def unreserve(self, nbytes: int):
+        with self._lock:
+            self._reserved -= nbytes
+
+    def _make_room(self, incoming: int, keep: str | None, strict: bool = True, reserve: bool = False):
+        """Evict idle models, least recently used first, until incoming more bytes fit the budget."""
+        if not self.budget:
+            if reserve:
+                with self._lock:
+                    self._reserved += incoming
+            return
+        evicted = []
+        with self._lock:
+            # draining models still hold their memory but cannot be evicted
+            used = (
+                sum(m.weight_bytes for m in self._models.values())
+                + sum(m.weight_bytes for m in self._draining)
+                + self._reserved
+            )
+            for name, m in list(self._models.items()):
+                if used + incoming <= self.budget:
+                    break
+                if name == keep or m.inflight:
+                    continue
+                del self._models[name]
+                used -= m.weight_bytes
+                evicted.append(m)
+            # a model that exceeds the budget on its own may still load once nothing else is resident
+            busy = strict and used + incoming > self.budget and bool(self._models or self._reserved)
+            if reserve and not busy:
+                self._reserved += incoming
+        for m in evicted:
+            m.close()
+            MODEL_EVICTIONS.labels(model=m.name).inc()
+            MODEL_RESIDENT.labels(model=m.name).set(0)
+            MODEL_RESIDENT_BYTES.labels(model=m.name).set(0)
+        if evicted:
+            gc.collect()
+        if busy:
+            raise HTTPException(
+                status_code=503,
+                detail="not enough memory to load the model while other models are busy",
+                headers={"Retry-After": str(MODEL_RETRY_AFTER)},
+            )
+
+    def reserved_bytes(self) -> int:
+        with self._lock:
+            return self._reserved
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(m.weight_bytes for m in self._models.values()) + sum(m.weight_bytes for m in self._draining)
+
+    def describe(self) -> list[dict]:
+        with self._lock:
+            models = list(self._models.values()) + self._draining
+        return [m.describe() for m in models]
+
+registry = ModelRegistry(MODEL_MEMORY_BUDGET)
+
+COMPARE_PROMPTS = [
+    "Explain in two sentences why the sky is blue.",
+    "Write a Python function that reverses a string.",
+    "List three uses of a paperclip.",
+    "Summarize the plot of Romeo and Juliet.",
+]
+
+class BackendComparison(BaseModel):
+    model: str | None = None  # None = DEFAULT_MODEL
+    backends: list[str] = list(BACKENDS)
+    prompts: list[str] = COMPARE_PROMPTS
+    max_new_tokens: int = 32
+
+_compare_lock = Lock()
+
+def _greedy(m, tokenizer, ids: list[int], max_new_tokens: int) -> tuple[list[int], _Timing]:
+    timing = _Timing()
+    input_ids = torch.tensor([ids], device=device)
+    output = m.generate(
+        input_ids=input_ids,
+        attention_mask=torch.ones_like(input_ids),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=tokenizer.eos_token_id,
+        **_stopping(None, len(ids), max_new_tokens, timing),
+    )
+    timing.finish()
+    return _trim_eos(tokenizer, output[0, len(ids):].tolist()), timing
+
+def _scored(m, ids: list[int], new_ids: list[int]) -> torch.Tensor:
+    """Log-probs the model gives each position of prompt + completion, for the completion positions."""
+    logits = m(input_ids=torch.tensor([ids + new_ids], device=device), use_cache=False).logits
+    return torch.log_softmax(logits[0, len(ids) - 1:-1].float(), dim=-1)
+
+def compare_backends(request: BackendComparison) -> dict:
+    """Load the model once per backend and measure it against fp32 on the same greedy generations.
+
+    Accuracy is judged two ways: how much of fp32's output each backend reproduces, and, feeding
+    fp32's output back in, how often the backend's top token agrees and how perplexed it is by it.
+    """
+    name = request.model or DEFAULT_MODEL
+    source = _model_source(name)
+    # one copy is resident at a time, and no backend peaks above the fp32 load (int8 quantizes in place)
+    reserved = _estimate_bytes(source, "fp32")
+    registry.reserve(reserved)
+    try:
+        return _compare_backends(request, name, source)
+    finally:
+        registry.unreserve(reserved)
+
+def _compare_backends(request: BackendComparison, name: str, source: str) -> dict:
+    tokenizer = AutoTokenizer.from_pretrained(source)
+    prompt_ids = [tokenizer(p, truncation=True)["input_ids"] for p in request.prompts]
+    reference: list[tuple[list[int], torch.Tensor]] = []
     results = []
-    for i in range(len(request.prompt)):
-        text = tokenizer.decode(output[i], skip_special_tokens=True)
-        results.append(text)
+    for backend in ["fp32"] + [b for b in dict.fromkeys(request.backends) if b != "fp32"]:
+        t0 = time.perf_counter()
+        m, effective = _load_model(source, backend)
+        load_seconds = time.perf_counter() - t0
+        with torch.inference_mode():
+            t0 = time.perf_counter()
+            _greedy(m, tokenizer, prompt_ids[0], request.max_new_tokens)  # warm-up; includes compilation
+            first_call = time.perf_counter() - t0
+            prefill, tps, exact, agreement, top1, nll = [], [], [], [], [], []
+            for i, ids in enumerate(prompt_ids):
+                new_ids, timing = _greedy(m, tokenizer, ids, request.max_new_tokens)
+                prefill.append(timing.first_at - timing.start)
+                if len(new_ids) > 1 and timing.end_at > timing.first_at:
+                    tps.append((len(new_ids) - 1) / (timing.end_at - timing.first_at))
+                if backend == "fp32":
+                    reference.append((new_ids, _scored(m, ids, new_ids)))
+                ref_ids, ref_logprobs = reference[i]
+                exact.append(new_ids == ref_ids)
+                common = next((k for k, (a, b) in enumerate(zip(new_ids, ref_ids)) if a != b), min(len(new_ids), len(ref_ids)))
+                agreement.append(common / max(len(ref_ids), 1))
+                if ref_ids:
+                    logprobs = _scored(m, ids, ref_ids)
+                    top1.append(float((logprobs.argmax(-1) == ref_logprobs.argmax(-1)).float().mean()))
+                    nll.append(float(-logprobs.gather(1, torch.tensor(ref_ids, device=device)[:, None]).mean()))
+        results.append({
+            "backend": backend,
+            "effective_backend": effective,
+            "load_seconds": round(load_seconds, 2),
+            "weight_bytes": _model_bytes(m),
+            "first_call_seconds": round(first_call, 2),
+            "prefill_ms": round(sum(prefill) / len(prefill) * 1000, 1) if prefill else None,
+            "decode_tokens_per_second": round(sum(tps) / len(tps), 2) if tps else None,
+            "exact_match": round(sum(exact) / len(exact), 3) if exact else None,
+            "token_agreement": round(sum(agreement) / len(agreement), 3) if agreement else None,
+            "top1_agreement": round(sum(top1) / len(top1), 3) if top1 else None,
+            "perplexity": round(float(torch.tensor(nll).mean().exp()), 3) if nll else None,
+        })
+        del m
+        gc.collect()
     return {
-        "generated_text": results[0] if len(results) == 1 else None,
-        "generated_texts": results,
-        "usage": {
-            "prompt_count": len(request.prompt),
-            "max_new_tokens": request.max_new_tokens,
-            "temperature": request.temperature,
-            "top_p": request.top_p
+        "model": name,
+        "requested_backend": INFERENCE_BACKEND,
+        "prompts": len(prompt_ids),
+        "max_new_tokens": request.max_new_tokens,
+        "results": results,
+    }
+
+@app.post("/backends/compare")
+def compare_backends_endpoint(request: BackendComparison):
+    """Accuracy/latency of each inference backend for a model; loads a fresh copy per backend, one at a time.
+
+    The fp32 footprint is reserved in MODEL_MEMORY_BUDGET for the run (idle models may be evicted for it);
+    503 with Retry-After when busy models leave no room.
+    """
+    unknown = [b for b in request.backends if b not in BACKENDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown backends: {', '.join(unknown)}")
+    if not request.prompts or request.max_new_tokens < 1:
+        raise HTTPException(status_code=400, detail="prompts must be non-empty and max_new_tokens >= 1")
+    if not _compare_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="a backend comparison is already running")
+    try:
+        return compare_backends(request)
+    finally:
+        _compare_lock.release()
+
+class ModelSwapRequest(BaseModel):
+    model: str | None = None  # served name to replace; defaults to DEFAULT_MODEL
+    source: str | None = None  # model to serve it from (MODEL_BASE_DIR name); defaults to reloading model itself
+    revision: str | None = None  # Hub revision, for a source fetched from the Hub
+
+@app.post("/models/swap", status_code=202)
+def swap_model(request: ModelSwapRequest):
+    """Load and warm a replacement in the background, switch new requests to it, then drain and free the old model."""
+    name = request.model or DEFAULT_MODEL
+    return registry.swap(name, request.source or name, request.revision).describe()
+
+@app.get("/models/swap/{swap_id}")
+def swap_status(swap_id: str):
+    swap = registry.get_swap(swap_id)
+    if swap is None:
+        raise HTTPException(status_code=404, detail="unknown swap")
+    return swap.describe()
+
+# --- model downloads -------------------------------------------------------
+
+_DOWNLOAD_READ_BYTES = 256 * 1024
+
+class _Cancelled(Exception):
+    pass
+
+class _RateLimiter:
+    """Byte-rate cap shared by a download's workers; 0 means unlimited."""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = Lock()
+
+    def consume(self, n: int):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + n / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+def _wanted_files(siblings: list[dict]) -> list[dict]:
+    """Top-level files from_pretrained needs: config, tokenizer and weights (safetensors in preference to .bin)."""
+    top = [f for f in siblings if "/" not in f["rfilename"] and not f["rfilename"].startswith(".")]
+    has_safetensors = any(f["rfilename"].endswith(".safetensors") for f in top)
+
+    def wanted(name: str) -> bool:
+        if name.endswith(".safetensors"):
+            return True
+        if name.endswith(".bin"):
+            return not has_safetensors and name.startswith("pytorch_model")
+        return name.endswith((".json", ".model", ".txt", ".tiktoken"))
+    return [f for f in top if wanted(f["rfilename"])]
+
+class _DownloadFile:
+    def __init__(self, name: str, size: int | None, sha256: str | None, git_sha1: str | None):
+        self.name = name
+        self.size = size
+        self.sha256 = sha256  # LFS files
+        self.git_sha1 = git_sha1  # small files stored in git: sha1 of the git blob
+        self.downloaded = 0
+        self.state = "pending"  # pending|downloading|verifying|done
+        self.verified = False
+        self.chunks: dict[int, int] = {}  # chunk index -> bytes already on disk from its start
+        self.lock = Lock()
+
+    def describe(self) -> dict:
+        return {"name": self.name, "size": self.size, "downloaded": self.downloaded, "state": self.state, "verified": self.verified}
+
+class DownloadJob:
+    """One repo download: resolve the commit, fetch the files in ranged chunks, verify them, move the directory into place.
+
+    Partial files and the list of finished chunks live under MODEL_BASE_DIR/.downloads keyed by commit,
+    so starting the same download again after a cancel, a failure or a restart resumes it.
+    """
+
+    def __init__(self, repo_id: str, revision: str, max_bytes_per_second: int):
+        self.id = uuid.uuid4().hex
+        self.repo_id = repo_id
+        self.revision = revision
+        self.commit: str | None = None
+        self.path = os.path.join(MODEL_BASE_DIR, repo_id)
+        self.state = "resolving"  # resolving|downloading|verifying|done|failed|cancelled
+        self.error: str | None = None
+        self.already_present = False
+        self.files: list[_DownloadFile] = []
+        self.max_bytes_per_second = max_bytes_per_second
+        self.limiter = _RateLimiter(max_bytes_per_second)
+        self.downloaded = 0
+        self.resumed = 0  # bytes found on disk from an earlier attempt
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self._transfer_started: float | None = None
+        self._transfer_ended: float | None = None
+        self._stop = Event()
+        self._cancelled = False
+        self._lock = Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.state not in ("done", "failed", "cancelled")
+
+    def cancel(self):
+        self._cancelled = True
+        self._stop.set()
+
+    def _url(self, name: str) -> str:
+        return f"{HF_ENDPOINT}/{self.repo_id}/resolve/{quote(self.commit, safe='')}/{quote(name)}"
+
+    def run(self):
+        DOWNLOADS_ACTIVE.inc()
+        try:
+            with httpx.Client(
+                follow_redirects=True,  # /resolve redirects LFS files to a CDN; httpx drops the token on cross-host hops
+                timeout=httpx.Timeout(30.0, read=60.0),
+                headers={"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else None,
+                limits=httpx.Limits(max_connections=DOWNLOAD_WORKERS),
+            ) as client:
+                self._resolve(client)
+                if self._installed():
+                    self.already_present = True
+                else:
+                    staging = os.path.join(MODEL_BASE_DIR, ".downloads", self.repo_id, self.commit.replace("/", "--"))
+                    os.makedirs(staging, exist_ok=True)
+                    with open(staging + ".lock", "w") as lock:
+                        try:
+                            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            raise RuntimeError("another process is downloading this revision") from None
+                        self._fetch(client, staging)
+                        self._install(staging)
+            self.state = "done"
+        except _Cancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            self.error = getattr(e, "detail", None) or str(e) or repr(e)
+            self.state = "cancelled" if self._cancelled else "failed"
+        finally:
+            self.finished_at = time.time()
+            DOWNLOADS_ACTIVE.dec()
+            DOWNLOADS.labels(result=self.state).inc()
+
+    def _resolve(self, client: httpx.Client):
+        r = client.get(f"{HF_ENDPOINT}/api/models/{self.repo_id}/revision/{quote(self.revision, safe='')}", params={"blobs": "true"})
+        if r.status_code in (401, 403):
+            raise RuntimeError(f"{self.repo_id} is gated or private; set HF_TOKEN")
+        if r.status_code == 404:
+            raise RuntimeError(f"{self.repo_id}@{self.revision} not found at {HF_ENDPOINT}")
+        r.raise_for_status()
+        info = r.json()
+        # pin every file to one commit so a branch moving mid-download cannot mix revisions
+        self.commit = info.get("sha") or self.revision
+        for f in _wanted_files(info.get("siblings", [])):
+            lfs = f.get("lfs") or {}
+            self.files.append(_DownloadFile(
+                f["rfilename"], lfs.get("size", f.get("size")), lfs.get("sha256"), None if lfs else f.get("blobId"),
+            ))
+        if not any(f.name == "config.json" for f in self.files):
+            raise RuntimeError(f"{self.repo_id} has no config.json; not a transformers model")
+
+    def _installed(self) -> bool:
+        try:
+            with open(os.path.join(self.path, ".download.json")) as f:
+                return json.load(f).get("commit") == self.commit
+        except (OSError, ValueError):
+            return False
+
+    def _fetch(self, client: httpx.Client, staging: str):
+        self.state = "downloading"
+        tasks, fds = [], {}
+        ranged = None
+        try:
+            for f in self.files:
+                path = os.path.join(staging, f.name)
+                if os.path.exists(path):  # finished and verified by an earlier attempt
+                    f.size = os.path.getsize(path)
+                    f.downloaded = f.size
+                    f.state, f.verified = "done", True
+                    self.resumed += f.size
+                    continue
+                part = path + ".part"
+                if f.size is not None and f.size > DOWNLOAD_CHUNK_BYTES:
+                    if ranged is None:
+                        ranged = self._supports_ranges(client, f)
+                    if ranged:
+                        self._resume(f, part)
+                        fds[f.name] = os.open(part, os.O_RDWR | os.O_CREAT)
+                        os.ftruncate(fds[f.name], f.size)
+                        for i in range(math.ceil(f.size / DOWNLOAD_CHUNK_BYTES)):
+                            start = i * DOWNLOAD_CHUNK_BYTES
+                            length = min(DOWNLOAD_CHUNK_BYTES, f.size - start)
+                            if f.chunks.get(i, 0) < length:
+                                tasks.append((f, i, start, length))
+                        continue
+                # small file, or a server that ignores Range: one plain GET, restarted from scratch
+                fds[f.name] = os.open(part, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+                tasks.append((f, None, 0, None))
+            self._transfer_started = time.monotonic()
+            with ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix=f"download-{self.id[:8]}") as pool:
+                futures = [pool.submit(self._fetch_chunk, client, fds[f.name], f, i, start, length, staging) for f, i, start, length in tasks]
+                done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+                errors = [e for e in (future.exception() for future in done) if e is not None]
+                if errors:
+                    self._stop.set()  # stop the other workers; chunks already on disk are kept for resume
+                    wait(futures)
+                    raise next((e for e in errors if not isinstance(e, _Cancelled)), errors[0])
+            self._transfer_ended = time.monotonic()
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        if self._stop.is_set():
+            raise _Cancelled()
+        self.state = "verifying"
+        with ThreadPoolExecutor(DOWNLOAD_WORKERS) as pool:
+            list(pool.map(lambda f: self._verify(f, staging), [f for f in self.files if f.state != "done"]))
+
+    def _supports_ranges(self, client: httpx.Client, f: _DownloadFile) -> bool:
+        with client.stream("GET", self._url(f.name), headers={"Range": "bytes=0-0"}) as r:
+            return r.status_code == 206
+
+    def _resume(self, f: _DownloadFile, part: str):
+        try:
+            with open(part + ".json") as fh:
+                state = json.load(fh)
+            if state["size"] == f.size and state["chunk_bytes"] == DOWNLOAD_CHUNK_BYTES and os.path.getsize(part) == f.size:
+                f.chunks = {int(i): n for i, n in state["chunks"].items()}
+        except (OSError, ValueError, KeyError):
+            f.chunks = {}
+        done = sum(f.chunks.values())
+        f.downloaded = done
+        self.resumed += done
+
+    def _record_chunk(self, f: _DownloadFile, index: int, have: int, part: str):
+        """Persist how far a chunk got; written when the chunk ends, so a hard kill only loses in-flight chunks."""
+        with f.lock:
+            f.chunks[index] = have
+            tmp = part + ".json.tmp"
+            with open(tmp, "w") as fh:
+                json.dump({"size": f.size, "chunk_bytes": DOWNLOAD_CHUNK_BYTES, "chunks": f.chunks}, fh)
+            os.replace(tmp, part + ".json")
+
+    def _count(self, f: _DownloadFile, n: int):
+        with self._lock:
+            f.downloaded += n
+            self.downloaded += n
+        if n > 0:
+            DOWNLOAD_BYTES.inc(n)
+
+    def _fetch_chunk(self, client: httpx.Client, fd: int, f: _DownloadFile, index: int | None, start: int, length: int | None, staging: str):
+        f.state = "downloading"
+        have = f.chunks.get(index, 0) if index is not None else 0
+        try:
+            for attempt in range(DOWNLOAD_RETRIES):
+                if length is None and have:
+                    # a plain GET cannot pick up where it stopped
+                    self._count(f, -have)
+                    have = 0
+                    os.ftruncate(fd, 0)
+                headers = {"Range": f"bytes={start + have}-{start + length - 1}"} if length is not None else None
+                try:
+                    with client.stream("GET", self._url(f.name), headers=headers) as r:
+                        if r.status_code == 429 or r.status_code >= 500:
+                            raise httpx.TransportError(f"HTTP {r.status_code}")
+                        if r.status_code != (206 if length is not None else 200):
+                            raise RuntimeError(f"{f.name}: unexpected HTTP {r.status_code}")
+                        for data in r.iter_bytes(_DOWNLOAD_READ_BYTES):
+                            if self._stop.is_set():
+                                raise _Cancelled()
+                            if length is not None:
+                                data = data[:length - have]
+                            os.pwrite(fd, data, start + have)
+                            have += len(data)
+                            self._count(f, len(data))
+                            self.limiter.consume(len(data))
+                    if length is None or have == length:
+                        return
+                except httpx.TransportError:
+                    if attempt == DOWNLOAD_RETRIES - 1:
+                        raise
+                time.sleep(min(2 ** attempt, 10))
+            raise RuntimeError(f"{f.name}: connection kept dropping")
+        finally:
+            if index is not None:
+                # success, cancel or failure alike: the next attempt resumes from here
+                self._record_chunk(f, index, have, os.path.join(staging, f.name + ".part"))
+
+    def _verify(self, f: _DownloadFile, staging: str):
+        path = os.path.join(staging, f.name)
+        part = path + ".part"
+        f.state = "verifying"
+        size = os.path.getsize(part)
+        h = None
+        if f.sha256:
+            h = hashlib.sha256()
+        elif f.git_sha1:
+            h = hashlib.sha1(b"blob %d\0" % size)
+        if h is not None:
+            with open(part, "rb") as fh:
+                while block := fh.read(8 * 1024 * 1024):
+                    h.update(block)
+        expected = f.sha256 or f.git_sha1
+        if (f.size is not None and size != f.size) or (h is not None and h.hexdigest() != expected):
+            # corrupt data cannot be resumed from; the next attempt fetches this file again
+            for stale in (part, part + ".json"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            self._count(f, -f.downloaded)
+            f.chunks, f.state = {}, "pending"
+            raise RuntimeError(f"{f.name}: checksum mismatch")
+        os.replace(part, path)
+        if os.path.exists(part + ".json"):
+            os.remove(part + ".json")
+        f.size, f.verified, f.state = size, h is not None, "done"
+
+    def _install(self, staging: str):
+        """Swap the verified directory into MODEL_BASE_DIR/<org>/<name> with a rename, so loaders never see a partial model."""
+        with open(os.path.join(staging, ".download.json"), "w") as fh:
+            json.dump({
+                "repo_id": self.repo_id,
+                "revision": self.revision,
+                "commit": self.commit,
+                "files": {f.name: f.sha256 or f.git_sha1 for f in self.files},
+            }, fh)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        old = staging + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.rename(self.path, old)  # models already loaded keep their mmapped (now unlinked) files
+        os.rename(staging, self.path)
+        shutil.rmtree(old, ignore_errors=True)
+        os.remove(staging + ".lock")
+        try:
+            os.removedirs(os.path.dirname(staging))  # prune now-empty staging parents
+        except OSError:
+            pass
+
+    def describe(self) -> dict:
+        total = sum(f.size for f in self.files) if self.files and all(f.size is not None for f in self.files) else None
+        end = self.finished_at or time.time()
+        rate = eta = None
+        if self._transfer_started is not None:
+            elapsed = (self._transfer_ended or time.monotonic()) - self._transfer_started
+            if elapsed > 0:
+                rate = (self.downloaded - self.resumed) / elapsed
+                if total is not None and rate > 0 and self.active:
+                    eta = round((total - self.downloaded) / rate, 1)
+        return {
+            "id": self.id,
+            "repo_id": self.repo_id,
+            "revision": self.revision,
+            "commit": self.commit,
+            "path": self.path,
+            "state": self.state,
+            "error": self.error,
+            "already_present": self.already_present,
+            "total_bytes": total,
+            "downloaded_bytes": self.downloaded,
+            "resumed_bytes": self.resumed,
+            "progress": round(self.downloaded / total, 4) if total else None,
+            "bytes_per_second": round(rate) if rate is not None else None,
+            "eta_seconds": eta,
+            "max_bytes_per_second": self.max_bytes_per_second or None,
+            "started_at": self.started_at,
+            "elapsed_seconds": round(end - self.started_at, 2),
+            "files": [f.describe() for f in self.files],
         }
+
+class DownloadManager:
+    def __init__(self):
+        self._jobs: OrderedDict[str, DownloadJob] = OrderedDict()
+        self._lock = Lock()
+
+    def start(self, repo_id: str, revision: str, max_bytes_per_second: int) -> DownloadJob:
+        """Start downloading repo_id, or return the download of it that is already running."""
+        _check_model_name(repo_id)
+        if not revision:
+            raise HTTPException(status_code=400, detail="revision must be non-empty")
+        if max_bytes_per_second < 0:
+            raise HTTPException(status_code=400, detail="max_bytes_per_second must be >= 0")
+        with self._lock:
+            for job in self._jobs.values():
+                if job.active and job.repo_id == repo_id and job.revision == revision:
+                    return job
+            job = DownloadJob(repo_id, revision, max_bytes_per_second)
+            self._jobs[job.id] = job
+        Thread(target=job.run, name=f"download-{repo_id}", daemon=True).start()
+        return job
+
+    def get(self, job_id: str) -> DownloadJob:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="unknown download")
+        return job
+
+    def describe(self) -> list[dict]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return [j.describe() for j in jobs]
+
+downloads = DownloadManager()
+
+class ModelDownloadRequest(BaseModel):
+    repo_id: str
+    revision: str = "main"
+    max_bytes_per_second: int | None = None  # defaults to DOWNLOAD_MAX_BYTES_PER_SECOND
+
+@app.post("/models/download", status_code=202)
+def download_model(request: ModelDownloadRequest):
+    """Fetch a model into MODEL_BASE_DIR in the background; repeat the call to resume an interrupted download."""
+    rate = DOWNLOAD_MAX_BYTES_PER_SECOND if request.max_bytes_per_second is None else request.max_bytes_per_second
+    return downloads.start(request.repo_id, request.revision, rate).describe()
+
+@app.get("/models/downloads")
+def list_downloads():
+    return {"downloads": downloads.describe()}
+
+@app.get("/models/downloads/{job_id}")
+def download_status(job_id: str):
+    return downloads.get(job_id).describe()
+
+@app.post("/models/downloads/{job_id}/cancel")
+def cancel_download(job_id: str):
+    """Stop a download; finished chunks stay on disk so starting it again resumes."""
+    job = downloads.get(job_id)
+    active = job.active
+    job.cancel()
+    return {"id": job_id, "cancelled": active}
+
+@app.on_event("startup")
+def load_default_model():
+    if admission.enabled:
+        # queued requests park a worker thread each, so the pool must fit running + queued
+        limiter = anyio.to_thread.current_default_thread_limiter()
+        limiter.total_tokens = max(limiter.total_tokens, ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE + 8)
+    # load in the background so /health answers at once; /ready flips when the model is warm, and
+    # requests that arrive earlier wait for the same load inside registry.acquire
+    Thread(target=_preload_default, name="preload-default-model", daemon=True).start()
+
+def _preload_default():
+    """Load the default model, retrying with capped exponential backoff until it is ready."""
+    global _default_error
+    delay = 1.0
+    while not _default_ready.is_set():
+        try:
+            registry.release(registry.acquire(DEFAULT_MODEL))
+        except Exception as e:
+            # e.g. the Hub is briefly unreachable or the budget is held by busy models
+            _default_error = getattr(e, "detail", None) or repr(e)
+            _default_ready.wait(delay)
+            delay = min(delay * 2, DEFAULT_MODEL_RETRY_MAX)
+            continue
+        _default_ready.set()
+    _default_error = None
+
+@app.post("/cancel/{request_id}")
+def cancel_generation(request_id: str):
+    """Stop an in-flight generation started with the same X-Request-Id."""
+    return {"request_id": request_id, "cancelled": cancellations.cancel(request_id)}
+
+@app.post("/generate")
+@GEN_TIME.time()
+def generate_text(
+    request: GenerationRequest,
+    x_request_id: str | None = Header(None),
+    x_request_timeout: float | None = Header(None),  # seconds the caller will wait for an answer
+):
+    if not request.prompt:
+        raise HTTPException(status_code=400, detail="prompt must be a non-empty list")
+    if request.temperature is None or request.temperature <= 0 or request.temperature > 2.0:
+        raise HTTPException(status_code=400, detail="temperature must be > 0 and <= 2.0")
+    if request.stream and len(request.prompt) != 1:
+        raise HTTPException(status_code=400, detail="stream supports exactly one prompt")
+    cancel = CancelToken(x_request_id, x_request_timeout) if x_request_id or x_request_timeout else None
+    if cancel is not None:
+        cancellations.register(cancel)
+    try:
+        admission.acquire()
+        try:
+            lm = registry.acquire(request.model or DEFAULT_MODEL)
+        except BaseException:
+            admission.release()
+            raise
+    except BaseException:
+        if cancel is not None:
+            cancellations.unregister(cancel)
+        raise
+
+    released = Lock()
+
+    def release():
+        # idempotent: both the worker and an abandoned response may try to release
+        if released.acquire(blocking=False):
+            registry.release(lm)
+            admission.release()
+
+    if request.stream:
+        try:
+            inputs = lm.tokenizer(
+                request.prompt,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+            )
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+        except Exception:
+            release()
+            if cancel is not None:
+                cancellations.unregister(cancel)
+            raise
+        stream = _stream_generation(lm, inputs, request, on_done=release, cancel=cancel)
+
+        def abandon():
+            state = inspect.getgeneratorstate(stream)
+            if state == inspect.GEN_SUSPENDED:
+                stream.close()  # runs the generator's finally, which cancels the worker
+            elif state == inspect.GEN_CREATED:
+                # the body never started, so no worker exists to release for us
+                stream.close()
+                release()
+                if cancel is not None:
+                    cancellations.unregister(cancel)
+
+        return GuardedStreamingResponse(stream, abandon, media_type="text/event-stream")
+    try:
+        if cancel is not None and cancel.cancelled:
+            # gave up while waiting for admission
+            cancel.stopped(request.max_new_tokens * len(request.prompt))
+            results = []
+        else:
+            results = lm.generate(request, cancel)
+    finally:
+        release()
+        if cancel is not None:
+            cancellations.unregister(cancel)
+    if cancel is not None and cancel.triggered:
+        if cancel.reason == "deadline":
+            raise HTTPException(status_code=504, detail="generation deadline exceeded")
+        raise HTTPException(status_code=499, detail="generation cancelled by client")
+    usage = _usage(lm, request, results)
+    _observe_usage(usage)
+    texts = [c.text for c in results]
+    return {
+        "generated_text": texts[0] if len(texts) == 1 else None,
+        "generated_texts": texts,
+        "usage": usage
     }